@@ -4,120 +4,1094 @@
 
 """Charm the application."""
 
+import dataclasses
+import hashlib
+import json
 import logging
+import os
+import re
+import time
+from typing import TYPE_CHECKING, Any, Callable, Mapping, Optional
 
 import ops
-from charms.data_platform_libs.v0.data_interfaces import DatabaseRequires
-from charms.redis_k8s.v0.redis import RedisRelationCharmEvents, RedisRequires
-from charms.traefik_k8s.v2.ingress import IngressPerAppRequirer, IngressPerAppReadyEvent
+from charms.redis_k8s.v0.redis import RedisRelationCharmEvents
+
+import compile_cache
+import hook_stats
+import mongo
+import object_storage
+import services
+from hook_stats import HookStats
+from redis_endpoint import RedisEndpointRequires
+from services import SERVICE_NAMES
+from snapshot import RelationSnapshot
+
+if TYPE_CHECKING:
+    from charms.data_platform_libs.v0.data_interfaces import DatabaseRequires
+    from charms.grafana_k8s.v0.grafana_dashboard import GrafanaDashboardProvider
+    from charms.loki_k8s.v1.loki_push_api import LokiPushApiConsumer
+    from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointProvider
+    from charms.traefik_k8s.v2.ingress import IngressPerAppReadyEvent, IngressPerAppRequirer
 
 logger = logging.getLogger(__name__)
 
+# Hooks and actions that need neither the MongoDB relation data nor ingress.
+# The data_interfaces library, and pydantic (through the ingress library),
+# make up most of the charm's import time, so they aren't loaded for these.
+LIGHT_DISPATCHES = frozenset({"update-status", "hook-stats"})
+# Hooks, other than the ingress relation ones, that the ingress library acts on,
+# or that may find web ready (or no longer ready) for ingress.
+INGRESS_DISPATCHES = frozenset(
+    {
+        "leader-elected",
+        "upgrade-charm",
+        "community-pebble-ready",
+        "community-pebble-check-failed",
+        "community-pebble-check-recovered",
+    }
+)
+# Hooks, other than the logging relation ones, that the loki_push_api library
+# acts on. It pulls in pydantic too, and the Loki endpoints can only change on
+# these, so other hooks use the endpoints it last found.
+LOGGING_DISPATCHES = frozenset({"config-changed", "upgrade-charm"})
+# Hooks, other than the metrics relation ones, that the prometheus_scrape
+# library acts on: it gives the unit's address again whenever the pod may have
+# a new one. Other hooks load it if the scrape jobs have to be given again.
+METRICS_DISPATCHES = frozenset({"community-pebble-ready"})
+# Hooks, other than the dashboard relation ones, on which the grafana_dashboard
+# library gives Grafana the dashboards again.
+DASHBOARD_DISPATCHES = frozenset({"leader-elected", "upgrade-charm", "config-changed"})
+
+PEER_RELATION = "overleaf-peers"
+# The peer application data key naming the unit that runs the singletons.
+SINGLETONS_KEY = "singletons"
+# The peer application data key holding the marker of the migrations that the
+# application last ran, whichever unit was the leader then.
+MIGRATED_KEY = "migrated"
+# A compile application provides the clsi endpoint; a web one requires it.
+CLSI_RELATION = "clsi"
+COMPILE_WORKERS_RELATION = "compile-workers"
+
+# Where the workload container's memory limit is, for cgroup v2 and v1. Under
+# v1, an unlimited container reports a value near the largest 64-bit integer.
+MEMORY_LIMIT_FILES = (
+    "/sys/fs/cgroup/memory.max",
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+)
+UNLIMITED_MEMORY = 1 << 60
+# The container's CPU quota: "<quota> <period>" (or "max <period>") for
+# cgroup v2, and separate quota (-1 if none) and period files for v1.
+CPU_MAX_FILE = "/sys/fs/cgroup/cpu.max"
+CPU_QUOTA_FILES = ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+SCRATCH_STORAGE = "compile-scratch"
+S3_RELATION = "s3"
+LOGGING_RELATION = "logging"
+METRICS_RELATION = "metrics-endpoint"
+DASHBOARD_RELATION = "grafana-dashboard"
+# The bundled alert rules, relative to the charm's root.
+ALERT_RULES_PATH = "./src/prometheus_alert_rules"
+
+
+def _dispatched() -> str:
+    """Return the name of the hook or action being dispatched.
+
+    This is empty when it isn't known (for example, in unit tests), in which
+    case everything should be loaded.
+    """
+    return os.environ.get("JUJU_DISPATCH_PATH", "").rpartition("/")[2]
+
+
+def _unit_address(unit_name: str, app_name: str, model_name: str) -> str:
+    """Return the in-cluster DNS name of a unit of a Kubernetes charm."""
+    return f"{unit_name.replace('/', '-')}.{app_name}-endpoints.{model_name}.svc.cluster.local"
+
+
+def _read(container: ops.Container, path: str) -> Optional[str]:
+    """Return the contents of a file in the container, or None if it can't be read."""
+    try:
+        return container.pull(path).read().strip()
+    except (ops.pebble.PathError, ops.pebble.APIError):
+        return None
+
+
+def _memory_limit(container: ops.Container) -> int:
+    """Return the container's memory limit in bytes, or 0 if it has none."""
+    for path in MEMORY_LIMIT_FILES:
+        value = _read(container, path)
+        if value is None:
+            continue
+        if value.isdigit() and int(value) < UNLIMITED_MEMORY:
+            return int(value)
+        return 0
+    return 0
+
+
+def _cpu_quota(container: ops.Container) -> float:
+    """Return the container's CPU quota in cores, or 0 if it has none."""
+    value = _read(container, CPU_MAX_FILE)
+    if value is not None:
+        quota, _, period = value.partition(" ")
+    else:
+        quota, period = (_read(container, path) or "" for path in CPU_QUOTA_FILES)
+    if not quota.isdigit() or not period.isdigit() or not int(period):
+        return 0
+    return int(quota) / int(period)
+
+
+def _make_data_dirs(container: ops.Container, scratch: bool):
+    """Make the data directories that the storage doesn't have yet."""
+    dirs = dict(services.DATA_DIRS)
+    if scratch:
+        dirs[services.SCRATCH_PATH] = tuple(services.SCRATCH_DIRS.values())
+    for parent, names in dirs.items():
+        try:
+            existing = {file.name for file in container.list_files(parent)}
+        except (ops.pebble.PathError, ops.pebble.APIError):
+            existing = set()
+        for name in names:
+            if name not in existing:
+                container.make_dir(
+                    f"{parent}/{name}", make_parents=True, user="www-data", group="www-data"
+                )
+
+
+def _push_service_files(container: ops.Container, layer: ops.pebble.Layer, starting: list[str]):
+    """Put the files that the charm's own services run from in place, before they start.
+
+    The configs follow from the layer, and the compile cache janitor runs
+    from the charm's copy, so none of them can lag behind the layer.
+    """
+    if services.FRONT in starting:
+        container.push(services.FRONT_CONFIG, services.render_front_config(layer), make_dirs=True)
+    if services.CLSI_ROUTER in starting:
+        container.push(
+            services.CLSI_ROUTER_CONFIG, services.render_clsi_router_config(layer), make_dirs=True
+        )
+    if services.COMPILE_CACHE in starting:
+        container.push(
+            services.COMPILE_CACHE_SCRIPT,
+            open(compile_cache.__file__).read(),
+            make_dirs=True,
+            permissions=0o755,
+        )
+    if services.METRICS in starting:
+        container.push(
+            services.METRICS_CONFIG, services.render_metrics_config(layer), make_dirs=True
+        )
+
+
+def _migrations_marker(container: ops.Container) -> Optional[str]:
+    """Return a hash of the migrations in the image, or None if it has none."""
+    try:
+        files = container.list_files(services.MIGRATIONS_DIR)
+    except (ops.pebble.PathError, ops.pebble.APIError):
+        return None
+    names = "\n".join(sorted(file.name for file in files))
+    return hashlib.sha256(names.encode()).hexdigest()
+
+
+def _run_migrations(container: ops.Container, environment: Mapping[str, str]) -> str:
+    """Run web's migrations, and return what they wrote.
+
+    Raises:
+        ops.pebble.ExecError: if the migrations fail.
+    """
+    process = container.exec(
+        list(services.MIGRATIONS_COMMAND),
+        environment=dict(environment),
+        working_dir=services.MIGRATIONS_DIR.rpartition("/")[0],
+        user="www-data",
+        timeout=services.MIGRATIONS_TIMEOUT,
+    )
+    stdout, _ = process.wait_output()
+    return stdout
+
+
+def _service_hash(service: ops.pebble.Service) -> str:
+    """Return a content hash of a Pebble service definition.
+
+    The service is canonicalised (sorted keys, Pebble's own dict form) so that
+    a freshly rendered service and the same service in the current plan hash
+    to the same value.
+    """
+    canonical = json.dumps(service.to_dict(), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def changed_services(
+    wanted: Mapping[str, ops.pebble.Service], current: Mapping[str, ops.pebble.Service]
+) -> list[str]:
+    """Return the names of the wanted services that differ from the current plan.
+
+    The names are returned in catalogue order, so that restarting them in that
+    order brings dependencies up before the services that use them.
+    """
+    changed = [
+        name
+        for name, service in wanted.items()
+        if name not in current or _service_hash(service) != _service_hash(current[name])
+    ]
+    return sorted(changed, key=services.start_order)
+
+
+def changed_log_targets(
+    wanted: Mapping[str, ops.pebble.LogTarget], current: Mapping[str, ops.pebble.LogTarget]
+) -> list[str]:
+    """Return the names of the wanted log targets that differ from the current plan."""
+    return sorted(
+        name
+        for name, target in wanted.items()
+        if name not in current or target.to_dict() != current[name].to_dict()
+    )
+
+
+def changed_checks(
+    wanted: Mapping[str, ops.pebble.Check], current: Mapping[str, ops.pebble.Check]
+) -> list[str]:
+    """Return the names of the wanted checks that differ from the current plan."""
+    return sorted(
+        name
+        for name, check in wanted.items()
+        if name not in current or check.to_dict() != current[name].to_dict()
+    )
+
+
+def _secret_reader(model: ops.Model) -> Callable[[str], dict[str, str]]:
+    """Return a function that reads the latest content of a secret by its URI.
+
+    It raises object_storage.SecretUnavailableError if the secret has been
+    removed, or the charm hasn't been granted it.
+    """
+
+    def read(uri: str) -> dict[str, str]:
+        try:
+            return model.get_secret(id=uri).get_content(refresh=True)
+        except ops.ModelError as e:
+            # SecretNotFoundError is a ModelError too.
+            logger.error("Cannot read the secret %s: %s", uri, e)
+            raise object_storage.SecretUnavailableError(uri) from e
+
+    return read
+
+
+def _with_stale_entries(layer: ops.pebble.Layer, plan: ops.pebble.Plan) -> ops.pebble.Layer:
+    """Return the layer, disabling what earlier layers have and this one doesn't.
+
+    This covers services and checks, such as the workers beyond a reduced
+    worker count, and log targets, such as those of a Loki that has left.
+    """
+    stale_services: dict[str, ops.pebble.ServiceDict] = {
+        name: {"override": "merge", "startup": "disabled"}
+        for name, service in plan.services.items()
+        if name not in layer.services and service.startup == "enabled"
+    }
+    stale_checks: dict[str, ops.pebble.CheckDict] = {
+        name: {"override": "merge", "startup": "disabled"}
+        for name, check in plan.checks.items()
+        if name not in layer.checks and check.startup != ops.pebble.CheckStartup.DISABLED
+    }
+    # Pebble can't remove a log target, but one for no services sends nothing.
+    stale_targets: dict[str, ops.pebble.LogTargetDict] = {
+        name: {
+            "override": "replace",
+            "type": target.type,  # type: ignore
+            "location": target.location,
+            "services": ["-all"],
+        }
+        for name, target in plan.log_targets.items()
+        if name not in layer.log_targets and target.services != ["-all"]
+    }
+    if not (stale_services or stale_checks or stale_targets):
+        return layer
+    layer_dict = layer.to_dict()
+    layer_dict["services"] = {**layer_dict.get("services", {}), **stale_services}
+    layer_dict["checks"] = {**layer_dict.get("checks", {}), **stale_checks}
+    layer_dict["log-targets"] = {**layer_dict.get("log-targets", {}), **stale_targets}
+    return ops.pebble.Layer(layer_dict)
+
 
 class OverleafK8sCharm(ops.CharmBase):
     """Charm the application."""
 
     on = RedisRelationCharmEvents()  # type: ignore
+    _stored = ops.StoredState()
 
     def __init__(self, framework: ops.Framework):
         super().__init__(framework)
-        framework.observe(self.on["community"].pebble_ready, self._configure_change)
+        # This must come first, so that every handler registered below (the
+        # charm libraries' included) is timed.
+        self.hook_stats = HookStats(self, hook_stats.stats_path(self.charm_dir))
+        # Counters of reconfigurations that were sent to Pebble versus ones
+        # that were skipped because nothing had changed. The generation counts
+        # the distinct sets of inputs the unit has converged to; "converged"
+        # is the hash of the latest. The container's memory limit and CPU
+        # quota only change when the pod is replaced, so are read once the
+        # container can be reached after a pebble-ready, as is whether the
+        # pod has compile scratch storage; "pod_probed" says they have been.
+        # "loki_endpoints" are the push URLs the loki_push_api library last
+        # found on the logging relation.
+        # "starting" holds when each service that hasn't
+        # passed its check yet was last (re)started, and "time_to_listen" how
+        # long each took to pass it, in seconds. "migrations_pending" says an
+        # install or upgrade asked for the migrations and they haven't been
+        # considered yet.
+        self._stored.set_default(
+            layers_applied=0,
+            layers_skipped=0,
+            generation=0,
+            converged="",
+            memory_limit=0,
+            cpu_quota=0.0,
+            compile_scratch=False,
+            pod_probed=False,
+            loki_endpoints=[],
+            ingress_open=False,
+            starting={},
+            time_to_listen={},
+            migrations_pending=False,
+        )
+        # Event handlers only mark the charm dirty; a single reconcile runs at
+        # the end of the dispatch, however many events asked for one. The
+        # unit's ingress is opened or closed after that, as web's readiness
+        # check says.
+        self._dirty = False
+        self._republish_ingress = False
+        self._recheck_ingress = False
+        self._check_startup = False
+        self._republish_metrics = False
+        framework.observe(framework.on.pre_commit, self._reconcile)
+        framework.observe(framework.on.pre_commit, self._update_ingress)
+        framework.observe(framework.on.pre_commit, self._record_time_to_listen)
+        framework.observe(framework.on.pre_commit, self._publish_metrics)
+        framework.observe(self.on["community"].pebble_ready, self._on_pebble_ready)
+        framework.observe(self.on["community"].pebble_check_failed, self._on_check_changed)
+        framework.observe(self.on["community"].pebble_check_recovered, self._on_check_changed)
+        framework.observe(self.on["ingress"].relation_joined, self._on_ingress_joined)
+        framework.observe(self.on.update_status, self._on_update_status)
+        framework.observe(self.on.upgrade_charm, self._on_pebble_ready)
+        framework.observe(self.on[SCRATCH_STORAGE].storage_attached, self._on_pebble_ready)
+        framework.observe(self.on.install, self._request_migrations)
+        framework.observe(self.on.upgrade_charm, self._request_migrations)
+        framework.observe(self.on.config_changed, self._mark_dirty)
+        framework.observe(self.on.secret_changed, self._mark_dirty)
+        # Units joining and leaving, and leadership changes, move the singletons
+        # or change who needs to reach them.
+        framework.observe(self.on.leader_elected, self._mark_dirty)
+        framework.observe(self.on.leader_elected, self._on_ingress_joined)
+        framework.observe(self.on[PEER_RELATION].relation_joined, self._mark_dirty)
+        framework.observe(self.on[PEER_RELATION].relation_changed, self._mark_dirty)
+        framework.observe(self.on[PEER_RELATION].relation_departed, self._mark_dirty)
+        framework.observe(self.on[CLSI_RELATION].relation_joined, self._mark_dirty)
+        framework.observe(self.on[CLSI_RELATION].relation_changed, self._mark_dirty)
+        framework.observe(self.on[COMPILE_WORKERS_RELATION].relation_changed, self._mark_dirty)
+        framework.observe(self.on[COMPILE_WORKERS_RELATION].relation_departed, self._mark_dirty)
+        framework.observe(self.on[COMPILE_WORKERS_RELATION].relation_broken, self._mark_dirty)
+        framework.observe(self.on[S3_RELATION].relation_joined, self._on_s3_joined)
+        framework.observe(self.on[S3_RELATION].relation_changed, self._mark_dirty)
+        framework.observe(self.on[S3_RELATION].relation_broken, self._mark_dirty)
+        framework.observe(self.on[LOGGING_RELATION].relation_broken, self._mark_dirty)
+        framework.observe(self.on.leader_elected, self._on_metrics_changed)
+        framework.observe(self.on.config_changed, self._on_metrics_changed)
+
+        dispatched = _dispatched()
+        light = dispatched in LIGHT_DISPATCHES
+        ingress_dispatch = dispatched.startswith("ingress-") or dispatched in INGRESS_DISPATCHES
 
         # Charm events defined in the database requires charm library.
-        self.database = DatabaseRequires(self, relation_name="database", database_name="overleaf")
-        framework.observe(self.database.on.database_created, self._configure_change)
-        self.redis = RedisRequires(self, "redis")
-        framework.observe(self.on["redis"].relation_updated, self._configure_change)
+        self.database: Optional["DatabaseRequires"] = None
+        if not light and not dispatched.startswith("ingress-"):
+            from charms.data_platform_libs.v0.data_interfaces import DatabaseRequires
+
+            self.database = DatabaseRequires(
+                self, relation_name="database", database_name="overleaf"
+            )
+            framework.observe(self.database.on.database_created, self._mark_dirty)
+            framework.observe(self.database.on.endpoints_changed, self._mark_dirty)
+            # Credential rotation only shows up as a plain relation change.
+            framework.observe(self.on["database"].relation_changed, self._mark_dirty)
+        self.redis = RedisEndpointRequires(self, "redis")
+        self.redis_roles = {
+            name: RedisEndpointRequires(self, name) for name in services.REDIS_ROLES
+        }
+        framework.observe(self.on["redis"].relation_updated, self._mark_dirty)
+
+        # The Loki units that the services' logs go to, through Pebble log
+        # targets in the layer. The charm has no Loki alert rules of its own.
+        self.logging: Optional["LokiPushApiConsumer"] = None
+        if not dispatched or dispatched.startswith("logging-") or dispatched in LOGGING_DISPATCHES:
+            from charms.loki_k8s.v1.loki_push_api import LokiPushApiConsumer
+
+            self.logging = LokiPushApiConsumer(
+                self, relation_name=LOGGING_RELATION, forward_alert_rules=False
+            )
+            framework.observe(self.logging.on.loki_push_api_endpoint_joined, self._mark_dirty)
+            framework.observe(self.logging.on.loki_push_api_endpoint_departed, self._mark_dirty)
+
+        # The scrape jobs, one for each Pebble service, and the bundled alert
+        # rules for Prometheus.
+        self.metrics_endpoint: Optional["MetricsEndpointProvider"] = None
+        if (
+            not dispatched
+            or dispatched.startswith("metrics-endpoint-")
+            or dispatched in METRICS_DISPATCHES
+        ):
+            self._load_metrics_endpoint()
+
+        # The dashboard in src/grafana_dashboards, built from the catalogue by
+        # src/dashboard.py.
+        self.grafana_dashboard: Optional["GrafanaDashboardProvider"] = None
+        if (
+            not dispatched
+            or dispatched.startswith("grafana-dashboard-")
+            or dispatched in DASHBOARD_DISPATCHES
+        ):
+            from charms.grafana_k8s.v0.grafana_dashboard import GrafanaDashboardProvider
+
+            self.grafana_dashboard = GrafanaDashboardProvider(
+                self, relation_name=DASHBOARD_RELATION
+            )
 
         # TODO: Figure out how to tell Traefik what the proper hostname is.
         # Tony now thinks this is in the traefik charm config, not in the
         # overleaf-k8s charm at all. The relation just tells traefik how to
         # reach the overleaf-k8s units, not how to expose them to the world.
-        self.ingress = IngressPerAppRequirer(self, port=4000, strip_prefix=True)
-        framework.observe(self.ingress.on.ready, self._on_ingress_ready)
-        framework.observe(self.ingress.on.revoked, self._on_ingress_revoked)
+        self.ingress: Optional["IngressPerAppRequirer"] = None
+        if not dispatched or ingress_dispatch:
+            self._load_ingress()
+
+        framework.observe(self.on.hook_stats_action, self._on_hook_stats_action)
+        framework.observe(self.on.run_migrations_action, self._on_run_migrations_action)
+
+    def _mark_dirty(self, _: ops.EventBase):
+        """Ask for a reconcile at the end of this dispatch."""
+        self._dirty = True
+
+    def _on_pebble_ready(self, _: ops.EventBase):
+        """Reconcile even if the inputs haven't changed.
+
+        The workload container (and so the Pebble plan) may have been
+        replaced, or the charm upgraded, since the unit last converged. Until
+        a layer has been applied since, and the pod's limits read, nothing
+        counts as converged, however many dispatches that takes.
+        """
+        self._dirty = True
+        self._stored.converged = ""
+        self._stored.pod_probed = False
+
+    def _on_metrics_changed(self, _: ops.EventBase):
+        self._republish_metrics = True
+
+    def _request_migrations(self, _: ops.EventBase):
+        """Run the migrations of a new workload once it is up."""
+        self._stored.migrations_pending = True
+
+    def _on_s3_joined(self, event: ops.RelationJoinedEvent):
+        """Ask the provider for a bucket named after the application."""
+        if self.unit.is_leader():
+            event.relation.data[self.app]["bucket"] = self.app.name
 
-    def _on_ingress_ready(self, event: IngressPerAppReadyEvent):
-        self.unit.set_ports(4000)
+    def _load_ingress(self) -> "IngressPerAppRequirer":
+        """Set up the ingress library, if it isn't already."""
+        if self.ingress is None:
+            from charms.traefik_k8s.v2.ingress import IngressPerAppRequirer
+
+            # Without a port, the library leaves publishing to the charm, which
+            # only does it once web is ready.
+            self.ingress = IngressPerAppRequirer(self, strip_prefix=True)
+            self.framework.observe(self.ingress.on.ready, self._on_ingress_ready)
+            self.framework.observe(self.ingress.on.revoked, self._on_ingress_revoked)
+        return self.ingress
+
+    def _load_metrics_endpoint(self) -> "MetricsEndpointProvider":
+        """Set up the prometheus_scrape library, if it isn't already."""
+        if self.metrics_endpoint is None:
+            from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointProvider
+
+            # The library gives the unit's address on its own, and asks for the
+            # scrape jobs whenever it gives them, so they are never stale.
+            self.metrics_endpoint = MetricsEndpointProvider(
+                self,
+                relation_name=METRICS_RELATION,
+                alert_rules_path=ALERT_RULES_PATH,
+                lookaside_jobs_callable=self._scrape_jobs,
+            )
+        return self.metrics_endpoint
+
+    def _scrape_jobs(self) -> list[dict]:
+        """Return the scrape jobs for the role and workers in the config.
+
+        If the config is invalid, these are the jobs of the default config.
+        """
+        cpu_quota = self._stored.cpu_quota
+        try:
+            runtime = services.node_runtime(
+                None, cpu_quota=cpu_quota, workers=str(self.config.get("workers", ""))
+            )
+            return services.scrape_jobs(runtime, str(self.config.get("role", services.FULL)))
+        except services.ConfigError as e:
+            logger.error("Giving the default scrape jobs: %s", e)
+            return services.scrape_jobs(
+                services.node_runtime(None, cpu_quota=cpu_quota), services.FULL
+            )
+
+    def _on_check_changed(self, event: ops.PebbleCheckEvent):
+        self._check_startup = True
+        if event.info.name == services.WEB_READY:
+            self._republish_ingress = True
+
+    def _on_ingress_joined(self, _: ops.EventBase):
+        self._republish_ingress = True
+
+    def _on_update_status(self, _: ops.EventBase):
+        # Web may have become ready without its check ever failing.
+        self._recheck_ingress = True
+        self._check_startup = True
+
+    def _update_ingress(self, _: ops.EventBase):
+        """Open the unit's ingress if web is ready, and close it if not.
+
+        Traefik routes to every unit that has published ingress data, so a
+        unit only publishes it, and opens web's port, once web is serving.
+        """
+        republish, self._republish_ingress = self._republish_ingress, False
+        recheck, self._recheck_ingress = self._recheck_ingress, False
+        if not (republish or recheck) or self.config.get("role") == services.COMPILE:
+            return
+        ready = self._web_ready(self.unit.containers["community"])
+        if ready == self._stored.ingress_open and not republish:
+            return
+        ingress = self._load_ingress()
+        if ready:
+            self.unit.set_ports(services.SERVICES_BY_NAME["web"].port)
+            ingress.provide_ingress_requirements(port=services.SERVICES_BY_NAME["web"].port)
+        else:
+            self.unit.set_ports()
+            for relation in ingress.relations:
+                relation.data[self.unit].clear()
+        if ready != self._stored.ingress_open:
+            logger.info(
+                "Web is %sready; %s ingress.",
+                "" if ready else "not ",
+                "opening" if ready else "closing",
+            )
+        self._stored.ingress_open = ready
+
+    def _record_time_to_listen(self, _: ops.EventBase):
+        """Record how long the services started since the last look took to listen.
+
+        A service is listening once its check passes. The check runs once a
+        period, so the time is only as precise as that; for the first success,
+        this counts back from the checks that have passed since.
+        """
+        check_startup, self._check_startup = self._check_startup, False
+        starting = self._stored.starting
+        if not check_startup or not starting:
+            return
+        container = self.unit.containers["community"]
+        if not container.can_connect():
+            return
+        now = time.time()
+        for name, check in container.get_checks(*starting).items():
+            if check.status != ops.pebble.CheckStatus.UP or check.successes == 0:
+                continue
+            passed_for = services.CHECK_PERIOD_SECONDS * ((check.successes or 1) - 1)
+            seconds = max(now - passed_for - starting[name], 0.0)
+            self._stored.time_to_listen[name] = round(seconds, 1)
+            del starting[name]
+            logger.info("%s was listening %.1fs after it started.", name, seconds)
+
+    def _publish_metrics(self, _: ops.EventBase):
+        """Give Prometheus the scrape jobs again, if they may have changed."""
+        republish, self._republish_metrics = self._republish_metrics, False
+        if not republish or self.model.get_relation(METRICS_RELATION) is None:
+            return
+        self._load_metrics_endpoint().set_scrape_job_spec()
+
+    def _web_ready(self, container: ops.Container) -> bool:
+        """Return whether web's readiness check has passed, and not failed since."""
+        if not container.can_connect():
+            return False
+        try:
+            check = container.get_check(services.WEB_READY)
+        except ops.ModelError:
+            return False
+        # Before a check has run, Pebble reports it as up. Pebble versions that
+        # count successes say whether it has passed yet.
+        passed = check.successes is None or check.successes > 0
+        return check.status == ops.pebble.CheckStatus.UP and passed
+
+    def _on_ingress_ready(self, event: "IngressPerAppReadyEvent"):
         logger.info("This app's ingress URL: %s", event.url)
 
     def _on_ingress_revoked(self, _):
         logger.info("This app no longer has ingress")
 
-    def _configure_change(self, _: ops.HookEvent):
-        """Handle pebble-ready event."""
-        # Check if we have all the information we need. If not, this is where
-        # the holistic approach makes things easy - we don't need to defer, we
-        # just wait for the next event to trigger this same method.
-        if not self.model.get_relation("database"):
-            logger.info("No relation to the MongoDB database yet.")
+    def _on_run_migrations_action(self, event: ops.ActionEvent):
+        """Run web's database migrations now, whether or not they have run before."""
+        container = self.unit.containers["community"]
+        if not container.can_connect():
+            event.fail("Pebble is not ready yet.")
+            return
+        environment = services.service_environment(container.get_plan().services, "web")
+        if environment is None:
+            event.fail("This unit does not run web.")
             return
-        mongo_data = self.get_relation_data()
-        if not mongo_data:
-            logger.info("MongoDB is still setting up.")
+        try:
+            output = _run_migrations(container, environment)
+        except ops.pebble.ExecError as e:
+            event.fail(f"The migrations failed: {e.stderr or e}")
             return
-        if not self.model.get_relation("redis"):
-            logger.info("No relation to the Redis database yet.")
+        marker = _migrations_marker(container) or ""
+        self._record_migrations(marker)
+        self._stored.migrations_pending = False
+        event.set_results({"marker": marker, "output": output[-4000:]})
+
+    def _migrate(self, container: ops.Container, layer: ops.pebble.Layer):
+        """Run web's migrations on the leader, if the image has new ones.
+
+        The services have already been started; the other units don't wait
+        for this at all. The marker of the migrations that have run is kept
+        in the peer application data, so that a new leader doesn't run them
+        again; until the peer relation exists, they wait.
+        """
+        peers = self.model.get_relation(PEER_RELATION)
+        if peers is None:
+            return
+        self._stored.migrations_pending = False
+        if not self.unit.is_leader():
+            return
+        environment = services.service_environment(layer.services, "web")
+        marker = _migrations_marker(container)
+        if (
+            environment is None
+            or marker is None
+            or marker == peers.data[self.app].get(MIGRATED_KEY)
+        ):
             return
-        if not self.redis.relation_data:
-            logger.info("Redis is still setting up.")
+        logger.info("Running web's migrations.")
+        try:
+            _run_migrations(container, environment)
+        except ops.pebble.ExecError as e:
+            # Not retried on every reconcile; the next upgrade or the
+            # run-migrations action tries again.
+            logger.error("Web's migrations failed: %s", e.stderr or e)
             return
+        self._record_migrations(marker)
+        logger.info("Web's migrations are done.")
+
+    def _record_migrations(self, marker: str):
+        """Record the migrations as run for the application, if this is the leader."""
+        peers = self.model.get_relation(PEER_RELATION)
+        if peers is not None and self.unit.is_leader():
+            peers.data[self.app][MIGRATED_KEY] = marker
+
+    def _on_hook_stats_action(self, event: ops.ActionEvent):
+        """Report latency percentiles and call counts per handler."""
+        summary = self.hook_stats.summary(event.params.get("handler"))
+        # Action result keys may only hold lowercase letters, digits and dashes.
+        handlers = {
+            re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-"): {
+                key: f"{value:.1f}" if isinstance(value, float) else str(value)
+                for key, value in stats.items()
+            }
+            for name, stats in summary.items()
+        }
+        event.set_results(
+            {
+                "handlers": handlers,
+                "layers-applied": self._stored.layers_applied,
+                "layers-skipped": self._stored.layers_skipped,
+                "time-to-listen": {
+                    name.replace("_", "-"): f"{seconds:.1f}"
+                    for name, seconds in self._stored.time_to_listen.items()
+                },
+            }
+        )
+
+    def _read_snapshot(self) -> RelationSnapshot:
+        """Read everything the charm needs from its relations, once."""
+        database = self.model.get_relation("database")
+        mongo: dict[str, str] = {}
+        if database is not None and self.database is not None:
+            mongo = self.database.fetch_relation_data([database.id]).get(database.id, {})
+        redis = self.model.get_relation("redis")
+        peers = self.model.get_relation(PEER_RELATION)
+        # Before the peer relation exists, the unit is on its own.
+        singleton_unit = self.unit.name
+        has_peers = False
+        if peers is not None:
+            singleton_unit = peers.data[self.app].get(SINGLETONS_KEY)
+            has_peers = bool(peers.units)
+        return RelationSnapshot(
+            database_related=database is not None,
+            mongo=mongo,
+            redis_related=redis is not None,
+            redis=self.redis.endpoint,
+            redis_roles={
+                name: endpoint
+                for name, requirer in self.redis_roles.items()
+                if (endpoint := requirer.endpoint) is not None
+            },
+            ingress_url=self.ingress.url if self.ingress is not None else None,
+            singleton_unit=singleton_unit,
+            has_peers=has_peers,
+            compile_units=self._compile_units(),
+            filestore_url=self._remote_filestore(),
+            s3=self._s3_settings(),
+            loki_endpoints=self._loki_endpoints(),
+        )
+
+    def _loki_endpoints(self) -> tuple[str, ...]:
+        """Return the push URLs of the Loki units on the logging relation.
+
+        Without the loki_push_api library loaded, these are the ones it last found.
+        """
+        if self.logging is not None:
+            urls = {endpoint["url"] for endpoint in self.logging.loki_endpoints}
+            self._stored.loki_endpoints = sorted(urls)
+        return tuple(self._stored.loki_endpoints)
+
+    def _s3_settings(self) -> Optional[object_storage.S3Settings]:
+        """Return the object storage settings the s3 provider has given, if any."""
+        relation = self.model.get_relation(S3_RELATION)
+        if relation is None or relation.app is None:
+            return None
+        return object_storage.parse_settings(
+            relation.data[relation.app], _secret_reader(self.model)
+        )
+
+    def _compile_units(self) -> tuple[str, ...]:
+        """Return the addresses of the related compile units, for a web application."""
+        if self.config.get("role") != services.WEB:
+            return ()
+        relation = self.model.get_relation(COMPILE_WORKERS_RELATION)
+        if relation is None:
+            return ()
+        hosts = (relation.data[unit].get("host") for unit in relation.units)
+        return tuple(sorted(filter(None, hosts)))
+
+    def _remote_filestore(self) -> Optional[str]:
+        """Return where a compile worker fetches the project files from.
+
+        A compile worker serves one web application; if more are related,
+        the first one's filestore is used.
+        """
+        if self.config.get("role") != services.COMPILE:
+            return None
+        for relation in self.model.relations[CLSI_RELATION]:
+            if relation.app is not None and "filestore" in relation.data[relation.app]:
+                return relation.data[relation.app]["filestore"]
+        return None
+
+    def _publish_compile_pool(self):
+        """Tell the related web applications where to send compiles.
+
+        Each compile unit gives its own address, as the output files of a
+        compile can only be fetched from the unit that ran it.
+        """
+        if self.config.get("role") != services.COMPILE:
+            return
+        self.unit.set_ports(services.CLSI_PORT)
+        host = _unit_address(self.unit.name, self.app.name, self.model.name)
+        for relation in self.model.relations[CLSI_RELATION]:
+            if relation.data[self.unit].get("host") != host:
+                relation.data[self.unit]["host"] = host
+
+    def _publish_filestore(self, snapshot: RelationSnapshot):
+        """Tell the compile workers where to fetch the project files from.
+
+        The files are linked from the compile requests by web's FILESTORE_HOST,
+        which is only reachable in this application; this is the unit that
+        runs the filestore the compile workers use instead.
+        """
+        relation = self.model.get_relation(COMPILE_WORKERS_RELATION)
+        if relation is None or snapshot.singleton_unit is None or not self.unit.is_leader():
+            return
+        address = _unit_address(snapshot.singleton_unit, self.app.name, self.model.name)
+        url = f"http://{address}:{services.SERVICES_BY_NAME['filestore'].port}"
+        if relation.data[self.app].get("filestore") != url:
+            relation.data[self.app]["filestore"] = url
+
+    def _place_singletons(self):
+        """Choose the unit that runs the singleton services, if this is the leader.
+
+        The choice only moves when the chosen unit leaves, so that scaling the
+        application doesn't bounce the singletons.
+        """
+        peers = self.model.get_relation(PEER_RELATION)
+        if peers is None or not self.unit.is_leader():
+            return
+        members = {self.unit.name} | {unit.name for unit in peers.units}
+        if peers.data[self.app].get(SINGLETONS_KEY) not in members:
+            logger.info("Placing the singleton services on %s.", self.unit.name)
+            peers.data[self.app][SINGLETONS_KEY] = self.unit.name
+
+    def _inputs_hash(self, snapshot: RelationSnapshot) -> str:
+        """Return a hash of everything the Pebble layer is rendered from."""
+        relations = dataclasses.asdict(snapshot)
+        # The ingress URL is informational; it doesn't go into the layer.
+        del relations["ingress_url"]
+        inputs = {
+            "relations": relations,
+            "config": dict(self.config),
+            "memory-limit": self._stored.memory_limit,
+            "cpu-quota": self._stored.cpu_quota,
+            "compile-scratch": self._stored.compile_scratch,
+        }
+        canonical = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _reconcile(self, _: ops.EventBase):
+        """Bring the workload in line with the relations and config, if asked to."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        self._place_singletons()
+        self._publish_compile_pool()
         container = self.unit.containers["community"]
+        if not self._stored.pod_probed and container.can_connect():
+            self._probe_pod(container)
+        # Check if we have all the information we need. If not, this is where
+        # the holistic approach makes things easy - we don't need to defer, we
+        # just wait for the next event to trigger this same method.
+        ready = self._read_inputs()
+        if ready is None:
+            return
+        snapshot, mongo_data = ready
+        inputs = self._inputs_hash(snapshot)
+        if inputs == self._stored.converged:
+            # An earlier dispatch already converged on exactly these inputs.
+            self._stored.layers_skipped += 1
+            logger.debug("Already at generation %d, nothing to do.", self._stored.generation)
+            return
         if not container.can_connect():
             logger.info("Pebble not ready yet.")
             return
 
-        # Add initial Pebble config layer using the Pebble API
-        container.add_layer("Overleaf service", self._pebble_layer(mongo_data), combine=True)
-
-        # Make Pebble reevaluate its plan, ensuring any services are started if enabled.
-        container.replan()
+        layer = self._render_or_block(mongo_data, snapshot)
+        if layer is None:
+            return
+        self._lay_out_storage(container)
+        self._apply_layer(container, layer)
+        if self._stored.migrations_pending:
+            self._migrate(container, layer)
+        if inputs != self._stored.converged:
+            self._stored.converged = inputs
+            self._stored.generation += 1
         self.unit.status = ops.ActiveStatus()
 
-    def get_relation_data(self):
+    def _read_inputs(self) -> Optional[tuple[RelationSnapshot, dict[str, Any]]]:
+        """Return the relation snapshot and MongoDB data, if the charm has all it needs.
+
+        Otherwise, the unit is blocked, or what it is waiting for is logged.
+        """
+        try:
+            snapshot = self._read_snapshot()
+        except object_storage.SecretUnavailableError as e:
+            # Going on without the object storage would move the files to the
+            # singleton unit's disk.
+            self._block(str(e))
+            return None
+        self._publish_filestore(snapshot)
+        try:
+            mongo_data = self.get_relation_data(snapshot)
+        except mongo.InvalidMongoURIError as e:
+            self._block_on_mongo(e)
+            return None
+        waiting_for = self._waiting_for(snapshot, mongo_data)
+        if waiting_for:
+            logger.info(waiting_for)
+            return None
+        return snapshot, mongo_data
+
+    def _render_or_block(
+        self, mongo_data: dict[str, Any], snapshot: RelationSnapshot
+    ) -> Optional[ops.pebble.Layer]:
+        """Return the Pebble layer, or block the unit if it can't be rendered."""
+        try:
+            return self._pebble_layer(mongo_data, snapshot)
+        except mongo.InvalidMongoURIError as e:
+            self._block_on_mongo(e)
+        except services.ConfigError as e:
+            logger.error("Invalid config: %s", e)
+            self._block(f"invalid config: {e}")
+        return None
+
+    def _block_on_mongo(self, error: mongo.InvalidMongoURIError):
+        logger.error("Invalid MongoDB relation data: %s", error)
+        self._block("invalid MongoDB relation data")
+
+    def _block(self, message: str):
+        """Block the unit until the next reconcile that gets as far as the layer.
+
+        The converged inputs are forgotten, or going back to them would be
+        skipped, leaving the unit blocked.
+        """
+        self.unit.status = ops.BlockedStatus(message)
+        self._stored.converged = ""
+
+    def _probe_pod(self, container: ops.Container):
+        """Read the pod's limits and storage, which only change with the pod.
+
+        This doesn't wait for the relations, so that the first layer is sized
+        for the pod however the events arrive.
+        """
+        self._stored.memory_limit = _memory_limit(container)
+        cpu_quota = _cpu_quota(container)
+        if cpu_quota != self._stored.cpu_quota:
+            # The default workers, and so the scrape jobs, follow the CPU quota.
+            self._stored.cpu_quota = cpu_quota
+            self._republish_metrics = True
+        self._stored.compile_scratch = bool(self.model.storages[SCRATCH_STORAGE])
+        self._stored.pod_probed = True
+
+    def _lay_out_storage(self, container: ops.Container):
+        """Lay out the data directories, and clsi's on the scratch storage if there is one.
+
+        This runs whenever the layer is applied, as the storage may have been
+        emptied or replaced without the pod being.
+        """
+        _make_data_dirs(container, self._stored.compile_scratch)
+        if self._stored.compile_scratch:
+            container.push(
+                services.SCRATCH_SETTINGS, services.render_scratch_settings(), make_dirs=True
+            )
+
+    def _waiting_for(self, snapshot: RelationSnapshot, mongo_data: dict[str, Any]) -> str:
+        """Return what the charm is still waiting for, if anything."""
+        role = self.config.get("role")
+        if role == services.COMPILE:
+            # clsi needs neither the databases nor the other services.
+            return ""
+        if role == services.WEB and not snapshot.compile_units:
+            return "No compile workers to send compiles to yet."
+        if not snapshot.database_related:
+            return "No relation to the MongoDB database yet."
+        if not mongo_data["MONGO_USER"]:
+            return "MongoDB is still setting up."
+        if not snapshot.redis_related:
+            return "No relation to the Redis database yet."
+        if snapshot.redis is None:
+            return "Redis is still setting up."
+        if snapshot.singleton_unit is None:
+            return "The leader has not placed the singleton services yet."
+        return ""
+
+    def _apply_layer(self, container: ops.Container, layer: ops.pebble.Layer):
+        """Add the layer and restart the services that it changes."""
+        plan = container.get_plan()
+        layer = _with_stale_entries(layer, plan)
+        changed = changed_services(layer.services, plan.services)
+        # Checks and log targets take effect without restarting anything.
+        checks = changed_checks(layer.checks, plan.checks)
+        targets = changed_log_targets(layer.log_targets, plan.log_targets)
+        if not changed and not checks and not targets:
+            # Relation flaps re-run this handler with the same inputs; there is
+            # no point in round-tripping the whole plan through Pebble again.
+            self._stored.layers_skipped += 1
+            logger.debug(
+                "Pebble layer unchanged, skipping restart (applied %d, skipped %d).",
+                self._stored.layers_applied,
+                self._stored.layers_skipped,
+            )
+        else:
+            container.add_layer("Overleaf service", layer, combine=True)
+            # Rather than replanning, which would bounce every service and drop
+            # active editing sessions, only restart the ones that changed.
+            enabled = [name for name in changed if layer.services[name].startup == "enabled"]
+            disabled = [name for name in changed if name not in enabled]
+            _push_service_files(container, layer, enabled)
+            if disabled:
+                # Services that this unit no longer runs. These go first, as
+                # they may hold ports that the others need, such as a front
+                # on web's port when web goes back to a single process.
+                container.stop(*disabled)
+            if enabled:
+                # Pebble starts them in the order of their "after" lists, and
+                # those that don't depend on each other in parallel.
+                container.restart(*enabled)
+                started = time.time()
+                for name in enabled:
+                    self._stored.starting[name] = started
+            for name in disabled:
+                self._stored.starting.pop(name, None)
+            self._update_checks(container, layer, plan.checks)
+            self._stored.layers_applied += 1
+            logger.info(
+                "Restarted %s (applied %d, skipped %d).",
+                ", ".join(changed) or "nothing",
+                self._stored.layers_applied,
+                self._stored.layers_skipped,
+            )
+            if checks:
+                logger.info("Updated the checks %s.", ", ".join(checks))
+            if targets:
+                logger.info("Updated the log targets %s.", ", ".join(targets))
+
+    def _update_checks(
+        self,
+        container: ops.Container,
+        layer: ops.pebble.Layer,
+        current: Mapping[str, ops.pebble.Check],
+    ):
+        """Start the checks that the layer enables, and stop the ones it disables.
+
+        Pebble doesn't start or stop a check when a layer only changes its
+        startup, as when the singletons move between units.
+        """
+        start, stop = [], []
+        for name, check in layer.checks.items():
+            was_enabled = (
+                name in current and current[name].startup != ops.pebble.CheckStartup.DISABLED
+            )
+            if check.startup == ops.pebble.CheckStartup.DISABLED:
+                if was_enabled:
+                    stop.append(name)
+            elif not was_enabled:
+                start.append(name)
+        if stop:
+            container.stop_checks(*stop)
+        if start:
+            container.start_checks(*start)
+
+    def get_relation_data(self, snapshot: RelationSnapshot):
         """Get database data from relation.
 
         Returns:
             Dict: Information needed for setting environment variables.
             Returns default if the relation data is not correctly initialized.
+
+        Raises:
+            InvalidMongoURIError: if the endpoints in the relation data are
+                not valid.
         """
         default = {
             "MONGO_USER": "",
             "MONGO_PASSWORD": "",
-            "MONGO_HOST": "",
-            "MONGO_PORT": "",
+            "MONGO_HOSTS": [],
             "MONGO_DB": "",
+            "MONGO_REPLICA_SET": None,
         }
 
-        if self.model.get_relation("database") is None:
+        if not snapshot.database_related:
             logger.info("MongoDB integration not set up yet.")
             return default
 
-        relation_id = self.database.relations[0].id
-        relation_data = self.database.fetch_relation_data()[relation_id]
-        # TODO: remove the next logging line.
-        logger.info("Raw relation data (id %s): %r", relation_id, relation_data)
+        relation_data = snapshot.mongo
 
-        endpoints = relation_data.get("endpoints", "").split(",")
-        if len(endpoints) < 1:
+        # Seed the driver with every member, so that services don't all pin
+        # to one host and a failover doesn't wait on rediscovery.
+        hosts = mongo.parse_endpoints(relation_data.get("endpoints", ""))
+        if not hosts:
             logger.info("No MongoDB endpoint provided yet.")
             return default
 
-        primary_endpoint = endpoints[0].split(":")
-        if len(primary_endpoint) < 2:
-            logger.info("Assuming primary endpoint is a plain hostname: %r", primary_endpoint)
-            host = primary_endpoint[0]
-            port = 27017
-        else:
-            host = primary_endpoint[0]
-            port = primary_endpoint[1]
-
         data = {
             "MONGO_USER": relation_data.get("username"),
             "MONGO_PASSWORD": relation_data.get("password"),
-            "MONGO_HOST": host,
-            "MONGO_PORT": port,
+            "MONGO_HOSTS": hosts,
             "MONGO_DB": relation_data.get("database"),
+            "MONGO_REPLICA_SET": mongo.replica_set(relation_data),
         }
 
         if None in (
@@ -129,25 +1103,101 @@ class OverleafK8sCharm(ops.CharmBase):
 
         return data
 
-    def _pebble_layer(self, database_settings: dict[str, str]) -> ops.pebble.Layer:
-        """Return a dictionary representing a Pebble layer."""
-        # The services are in overleaf/server-ce/runit.
-        # There's 14 of them.
-        # When you look at each, there's a run script.
-        # In that script, the relevant lines are the last 3:
-        # source /etc/overleaf/env.sh
-        # This one holds the common variables.
-        # export LISTEN_ADDRESS=127.0.0.1
-        # This one holds the variables specific for the service.
-        # exec /sbin/setuser www-data /usr/bin/node $NODE_PARAMS /overleaf/services/chat/app.js >> /var/log/overleaf/chat.log 2>&1
-        # This one has the user, 'www-data', and the actual command. We copy it without $NODE_PARAMS as that's not necessary for now.
-        mongo_uri = f"mongodb://{database_settings['MONGO_USER']}:{database_settings['MONGO_PASSWORD']}@{database_settings['MONGO_HOST']}:{database_settings['MONGO_PORT']}/{database_settings['MONGO_DB']}?replicaSet=mongodb-k8s&authSource=admin"
-        # TODO: remove this logging, since it contains a password.
-        logger.info("Setting Mongo URI to %r from %r", mongo_uri, database_settings)
-        if self.redis.relation_data:
-            redis_hostname = self.redis.relation_data.get("hostname")
-        else:
-            redis_hostname = ""
+    def _mongo_env(self, database_settings: dict[str, Any]) -> dict[str, dict[str, str]]:
+        """Return the MongoDB environment group, with a URI for each service.
+
+        Each service gets the connection options for its role from the
+        catalogue, overridden by the mongo-options config.
+        """
+        overrides = {}
+        per_service = services.parse_per_service(str(self.config.get("mongo-options", "")))
+        for name, value in per_service.items():
+            try:
+                overrides[name] = mongo.parse_options(value)
+            except ValueError as e:
+                raise services.ConfigError(f"mongo-options for {name}: {e}") from e
+        env = {services.MONGO: {}}
+        for service in services.SERVICES:
+            if services.MONGO not in service.env_groups:
+                continue
+            options = dict(service.mongo_options)
+            options.update(overrides.get(service.name, {}))
+            uri = mongo.build_uri(
+                database_settings["MONGO_USER"],
+                database_settings["MONGO_PASSWORD"],
+                database_settings["MONGO_HOSTS"],
+                database_settings["MONGO_DB"],
+                database_settings["MONGO_REPLICA_SET"],
+                options,
+            )
+            logger.debug("Setting Mongo URI for %s to %s", service.name, mongo.redact(uri))
+            service_env = {"OVERLEAF_MONGO_URL": uri}
+            if service.mongo_pool_variable and "maxPoolSize" in options:
+                service_env[service.mongo_pool_variable] = options["maxPoolSize"]
+            env[f"{services.MONGO}/{service.name}"] = service_env
+        return env
+
+    def _redis_env(self, snapshot: RelationSnapshot) -> dict[str, str]:
+        """Return the Redis variables, pointing each kind of traffic at its Redis."""
+        main = snapshot.redis
+        if main is None:
+            return {}
+        # Writes must go to the primary, not whichever Redis unit sorts first.
+        env = {"OVERLEAF_REDIS_HOST": main.primary, "OVERLEAF_REDIS_PORT": main.port}
+        for name, prefix in services.REDIS_ROLES.items():
+            endpoint = snapshot.redis_roles.get(name, main)
+            env[f"{prefix}_HOST"] = endpoint.primary
+            env[f"{prefix}_PORT"] = endpoint.port
+        return env
+
+    def _use_remote_services(
+        self, snapshot: RelationSnapshot, common_env: dict[str, str]
+    ) -> set[str]:
+        """Point the services at the ones that run elsewhere.
+
+        Returns:
+            The singleton services that another unit runs.
+        """
+        if snapshot.filestore_url:
+            # clsi fetches the files from here, whatever host the URLs have.
+            common_env["FILESTORE_DOMAIN_OVERRIDE"] = snapshot.filestore_url
+        if snapshot.singleton_unit in (None, self.unit.name):
+            return set()
+        address = _unit_address(snapshot.singleton_unit, self.app.name, self.model.name)
+        remote = set()
+        for service in services.singletons(object_storage=snapshot.s3 is not None):
+            common_env[service.host_variable] = address
+            remote.add(service.name)
+        return remote
+
+    def _shared_singletons(self, snapshot: RelationSnapshot) -> dict[str, dict[str, str]]:
+        """Return the groups that open this unit's singletons to the other units.
+
+        The singletons only listen on localhost unless this unit runs them
+        and there are other units to reach them. The compile workers fetch the
+        project files from filestore here, even when every unit runs it.
+        """
+        if snapshot.singleton_unit != self.unit.name:
+            return {}
+        shared = set()
+        if snapshot.has_peers:
+            shared = {s.name for s in services.singletons(object_storage=snapshot.s3 is not None)}
+        if snapshot.compile_units:
+            shared.add("filestore")
+        return {f"{services.COMMON}/{name}": {"LISTEN_ADDRESS": "0.0.0.0"} for name in shared}
+
+    def _pebble_layer(
+        self, database_settings: dict[str, Any], snapshot: RelationSnapshot
+    ) -> ops.pebble.Layer:
+        """Return the Pebble layer for the Overleaf services.
+
+        Raises:
+            InvalidMongoURIError: if the MongoDB relation data doesn't make a
+                valid connection string.
+            ConfigError: if the charm config is invalid.
+        """
+        role = str(self.config.get("role", services.FULL))
+        disabled = set(SERVICE_NAMES) - services.role_services(role)
         common_env = {
             "CHAT_HOST": "127.0.0.1",
             "CLSI_HOST": "127.0.0.1",
@@ -165,10 +1215,10 @@ class OverleafK8sCharm(ops.CharmBase):
             # For the charm, we want to use MongoDB provided by an integration
             # instead.
             "MONGO_ENABLED": "false",
+            "LOG_LEVEL": self._log_level(),
             "NOTIFICATIONS_HOST": "127.0.0.1",
+            "OVERLEAF_DATA_PATH": services.DATA_PATH,
             "OVERLEAF_LISTEN_IP": "0.0.0.0",
-            "OVERLEAF_MONGO_URL": mongo_uri,
-            "OVERLEAF_REDIS_HOST": redis_hostname,
             "PROJECT_HISTORY_HOST": "127.0.0.1",
             "REALTIME_HOST": "127.0.0.1",
             # Similar to MONGO_ENABLED, this means "a Redis will be provided",
@@ -179,7 +1229,7 @@ class OverleafK8sCharm(ops.CharmBase):
             "WEB_HOST": "127.0.0.1",
             "WEB_API_HOST": "127.0.0.1",
         }
-        # "OVERLEAF_DATA_PATH":"data/overleaf",
+        disabled |= self._use_remote_services(snapshot, common_env)
         # "REDIS_AOF_PERSISTENCE":"true",
         # "OVERLEAF_APP_NAME":"Our Overleaf Instance",
         # "ENABLED_LINKED_FILE_TYPES":"project_file,project_output_file",
@@ -193,165 +1243,69 @@ class OverleafK8sCharm(ops.CharmBase):
         # TODO: this should be a generated secret
         web_api_password = "overleaf"
 
-        chat_env = common_env.copy()
-        chat_env.update({"LISTEN_ADDRESS": "127.0.0.1"})
-        clsi_env = common_env.copy()
-        clsi_env.update({"LISTEN_ADDRESS": "127.0.0.1"})
-        spelling_env = common_env.copy()
-        spelling_env.update({"LISTEN_ADDRESS": "127.0.0.1"})
-        contacts_env = common_env.copy()
-        contacts_env.update({"LISTEN_ADDRESS": "127.0.0.1"})
-        docstore_env = common_env.copy()
-        docstore_env.update({"LISTEN_ADDRESS": "127.0.0.1"})
-        document_updater_env = common_env.copy()
-        document_updater_env.update({"LISTEN_ADDRESS": "127.0.0.1"})
-        filestore_env = common_env.copy()
-        filestore_env.update({"LISTEN_ADDRESS": "127.0.0.1"})
-        # TODO: history_v1 doesn't really need all of what's in common, but does
-        # need the Mongo settings.
-        history_v1_env = common_env.copy()
-        history_v1_env.update({"NODE_CONFIG_DIR": "/overleaf/services/history-v1/config"})
-        notifications_env = common_env.copy()
-        notifications_env.update({"LISTEN_ADDRESS": "127.0.0.1"})
-        project_history_env = common_env.copy()
-        project_history_env.update({"LISTEN_ADDRESS": "127.0.0.1"})
-        real_time_env = common_env.copy()
-        real_time_env.update(
-            {"LISTEN_ADDRESS": "127.0.0.1", "OVERLEAF_SESSION_SECRET": session_secret}
+        clsi_env: dict[str, str] = {}
+        if self._stored.compile_scratch:
+            clsi_env["OVERLEAF_CONFIG"] = services.SCRATCH_SETTINGS
+        env_groups: dict[str, Mapping[str, str]] = {
+            services.COMMON: common_env,
+            f"{services.COMMON}/clsi": clsi_env,
+            **self._shared_singletons(snapshot),
+        }
+        if role == services.COMPILE:
+            # clsi takes compiles from the web units.
+            clsi_env["LISTEN_ADDRESS"] = "0.0.0.0"
+        else:
+            env_groups.update(
+                {
+                    **self._mongo_env(database_settings),
+                    services.REDIS: self._redis_env(snapshot),
+                    services.SESSION: {"OVERLEAF_SESSION_SECRET": session_secret},
+                    services.WEB_API_CREDENTIALS: {
+                        "WEB_API_USER": web_api_user,
+                        "WEB_API_PASSWORD": web_api_password,
+                    },
+                }
+            )
+            if snapshot.s3 is not None:
+                env_groups.update(services.s3_env_groups(snapshot.s3))
+        runtime = services.node_runtime(
+            self._stored.memory_limit or None,
+            str(self.config.get("node-options", "")),
+            str(self.config.get("uv-threadpool-size", "")),
+            self._stored.cpu_quota,
+            str(self.config.get("workers", "")),
         )
-        web_api_env = common_env.copy()
-        web_api_env.update(
-            {
-                "LISTEN_ADDRESS": "127.0.0.1",
-                "ENABLED_SERVICES": "api",
-                "METRICS_APP_NAME": "web-api",
-                "OVERLEAF_SESSION_SECRET": session_secret,
-                "WEB_API_USER": web_api_user,
-                "WEB_API_PASSWORD": web_api_password,
-            }
+        cache = services.CompileCache(
+            services.SCRATCH_PATH if self._stored.compile_scratch else services.DATA_PATH,
+            services.parse_size(str(self.config.get("compile-cache-size", ""))),
         )
-        web_env = common_env.copy()
-        web_env.update(
-            {
-                "LISTEN_ADDRESS": "0.0.0.0",
-                "ENABLED_SERVICES": "web",
-                "WEB_PORT": "4000",
-                "OVERLEAF_SESSION_SECRET": session_secret,
-                "WEB_API_USER": web_api_user,
-                "WEB_API_PASSWORD": web_api_password,
-            }
+        layer = services.render_layer(
+            env_groups, disabled, runtime, cache, compile_units=snapshot.compile_units
         )
-        pebble_layer: ops.pebble.LayerDict = {
-            "summary": "Overleaf service",
-            "description": "pebble config layer for Overleaf server",
-            "services": {
-                "chat": {
-                    "override": "replace",
-                    "summary": "chat",
-                    "command": "/usr/bin/node /overleaf/services/chat/app.js",
-                    "startup": "enabled",
-                    "environment": chat_env,
-                    "user": "www-data",
-                },
-                "clsi": {
-                    "override": "replace",
-                    "summary": "clsi",
-                    "command": "/usr/bin/node /overleaf/services/clsi/app.js",
-                    "startup": "enabled",
-                    "environment": clsi_env,
-                    "user": "www-data",
-                },
-                "contacts": {
-                    "override": "replace",
-                    "summary": "contacts",
-                    "command": "/usr/bin/node /overleaf/services/contacts/app.js",
-                    "startup": "enabled",
-                    "environment": contacts_env,
-                    "user": "www-data",
-                },
-                "docstore": {
-                    "override": "replace",
-                    "summary": "docstore",
-                    "command": "/usr/bin/node /overleaf/services/docstore/app.js",
-                    "startup": "enabled",
-                    "environment": docstore_env,
-                    "user": "www-data",
-                },
-                "document_updater": {
-                    "override": "replace",
-                    "summary": "document updater",
-                    "command": "/usr/bin/node /overleaf/services/document-updater/app.js",
-                    "startup": "enabled",
-                    "environment": document_updater_env,
-                    "user": "www-data",
-                },
-                "filestore": {
-                    "override": "replace",
-                    "summary": "filestore",
-                    "command": "/usr/bin/node /overleaf/services/filestore/app.js",
-                    "startup": "enabled",
-                    "environment": filestore_env,
-                    "user": "www-data",
-                },
-                "history_v1": {
-                    "override": "replace",
-                    "summary": "history v1",
-                    "command": "/usr/bin/node /overleaf/services/history-v1/app.js",
-                    "startup": "enabled",
-                    "environment": history_v1_env,
-                    "user": "www-data",
-                },
-                "notifications": {
-                    "override": "replace",
-                    "summary": "notifications",
-                    "command": "/usr/bin/node /overleaf/services/notifications/app.js",
-                    "startup": "enabled",
-                    "environment": notifications_env,
-                    "user": "www-data",
-                },
-                "project_history": {
-                    "override": "replace",
-                    "summary": "project history",
-                    "command": "/usr/bin/node /overleaf/services/project-history/app.js",
-                    "startup": "enabled",
-                    "environment": project_history_env,
-                    "user": "www-data",
-                },
-                "real_time": {
-                    "override": "replace",
-                    "summary": "real time",
-                    "command": "/usr/bin/node /overleaf/services/real-time/app.js",
-                    "startup": "enabled",
-                    "environment": real_time_env,
-                    "user": "www-data",
-                },
-                "spelling": {
-                    "override": "replace",
-                    "summary": "spelling",
-                    "command": "/usr/bin/node /overleaf/services/spelling/app.js",
-                    "startup": "enabled",
-                    "environment": spelling_env,
-                    "user": "www-data",
-                },
-                "web_api": {
-                    "override": "replace",
-                    "summary": "web api",
-                    "command": "/usr/bin/node /overleaf/services/web/app.js",
-                    "startup": "enabled",
-                    "environment": web_api_env,
-                    "user": "www-data",
-                },
-                "web": {
-                    "override": "replace",
-                    "summary": "web",
-                    "command": "/usr/bin/node /overleaf/services/web/app.js",
-                    "startup": "enabled",
-                    "environment": web_env,
-                    "user": "www-data",
-                },
-            },
-        }
-        return ops.pebble.Layer(pebble_layer)
+        if snapshot.loki_endpoints:
+            labels = {
+                "juju_model": self.model.name,
+                "juju_model_uuid": self.model.uuid,
+                "juju_application": self.app.name,
+                "juju_unit": self.unit.name,
+                "juju_charm": self.meta.name,
+            }
+            targets = services.render_log_targets(snapshot.loki_endpoints, labels)
+            layer = ops.pebble.Layer({**layer.to_dict(), "log-targets": targets})
+        return layer
+
+    def _log_level(self) -> str:
+        """Return the services' log level from the config.
+
+        Raises:
+            ConfigError: if it isn't one of the levels the services know.
+        """
+        level = str(self.config.get("log-level", "info"))
+        if level not in services.LOG_LEVELS:
+            raise services.ConfigError(
+                f"log-level must be one of {', '.join(services.LOG_LEVELS)}, not {level!r}"
+            )
+        return level
 
 
 if __name__ == "__main__":  # pragma: nocover
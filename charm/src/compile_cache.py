@@ -0,0 +1,248 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+"""The compile cache janitor, which runs in the workload container.
+
+clsi keeps a directory for each project (or each project and user) under its
+compiles and output directories, and reuses it for incremental compiles. The
+janitor keeps their total size under a budget, by removing the directories of
+the projects compiled least recently, and serves Prometheus metrics on how
+often a compile found its directory still there and what was evicted.
+
+This only uses the standard library: the charm pushes the file into the
+workload container, and Pebble runs it with the image's Python.
+"""
+
+import argparse
+import dataclasses
+import http.server
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# The share of the volume the cache may fill when no budget is given.
+DEFAULT_BUDGET_FRACTION = 0.25
+# Eviction goes down to this share of the budget, so that it doesn't run
+# again as soon as the next project compiles.
+LOW_WATER = 0.9
+# Directories used more recently than this may be in the middle of a compile.
+MIN_IDLE_SECONDS = 300
+STATE_FILE = ".compile-cache.json"
+SUBDIRS = ("compiles", "output")
+COUNTERS = ("hits", "misses", "evictions", "evicted_bytes")
+
+
+@dataclasses.dataclass
+class Entry:
+    """A project's directories in the cache.
+
+    Attributes:
+        last_used: when a compile last wrote to them, as a Unix time.
+        size: their total size on disk, in bytes.
+    """
+
+    last_used: float
+    size: int
+
+
+def _last_used(path: str) -> float:
+    """Return when anything directly in the directory last changed."""
+    last_used = os.stat(path).st_mtime
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                last_used = max(last_used, entry.stat(follow_symlinks=False).st_mtime)
+            except OSError:
+                continue
+    return last_used
+
+
+def _disk_usage(path: str) -> int:
+    """Return the space the directory takes on disk, in bytes."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+            except OSError:
+                continue
+    return total
+
+
+def scan(roots: Iterable[str], previous: dict[str, Entry]) -> dict[str, Entry]:
+    """Return the cache entries under the roots, by project directory name.
+
+    Sizes are only measured again for the directories that changed since the
+    previous scan.
+    """
+    paths: dict[str, list[str]] = {}
+    for root in roots:
+        try:
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        paths.setdefault(entry.name, []).append(entry.path)
+        except FileNotFoundError:
+            continue
+    entries = {}
+    for key, key_paths in paths.items():
+        try:
+            last_used = max(_last_used(path) for path in key_paths)
+        except OSError:
+            continue
+        known = previous.get(key)
+        if known is not None and known.last_used == last_used:
+            entries[key] = known
+        else:
+            entries[key] = Entry(last_used, sum(_disk_usage(path) for path in key_paths))
+    return entries
+
+
+def select_evictions(entries: dict[str, Entry], budget: int, now: float) -> list[str]:
+    """Return the entries to evict to bring the cache under its budget, oldest first."""
+    total = sum(entry.size for entry in entries.values())
+    if total <= budget:
+        return []
+    target = budget * LOW_WATER
+    evict = []
+    for key, entry in sorted(entries.items(), key=lambda item: item[1].last_used):
+        if total <= target or now - entry.last_used < MIN_IDLE_SECONDS:
+            break
+        evict.append(key)
+        total -= entry.size
+    return evict
+
+
+class Janitor:
+    """Keep the compile cache under its budget, and count what happens to it."""
+
+    def __init__(self, root: str, budget: int = 0):
+        self.roots = [os.path.join(root, subdir) for subdir in SUBDIRS]
+        self.state_path = os.path.join(root, STATE_FILE)
+        if not budget:
+            stats = os.statvfs(root)
+            budget = int(stats.f_blocks * stats.f_frsize * DEFAULT_BUDGET_FRACTION)
+        self.budget = budget
+        self.entries: dict[str, Entry] = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        """Pick up the entries and counters from before a restart."""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.entries = {key: Entry(**entry) for key, entry in state.get("entries", {}).items()}
+        self.counters.update(state.get("counters", {}))
+
+    def _save(self):
+        state = {
+            "entries": {key: dataclasses.asdict(entry) for key, entry in self.entries.items()},
+            "counters": self.counters,
+        }
+        tmp = f"{self.state_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    def run_once(self, now: Optional[float] = None):
+        """Scan the cache, count the compiles since the last scan, and evict."""
+        now = time.time() if now is None else now
+        entries = scan(self.roots, self.entries)
+        hits = misses = 0
+        for key, entry in entries.items():
+            known = self.entries.get(key)
+            if known is None:
+                misses += 1
+            elif entry.last_used > known.last_used:
+                hits += 1
+        evicted = select_evictions(entries, self.budget, now)
+        evicted_bytes = 0
+        for key in evicted:
+            for root in self.roots:
+                shutil.rmtree(os.path.join(root, key), ignore_errors=True)
+            evicted_bytes += entries.pop(key).size
+        if evicted:
+            logger.info("Evicted %d projects, %d bytes.", len(evicted), evicted_bytes)
+        with self._lock:
+            self.entries = entries
+            self.counters["hits"] += hits
+            self.counters["misses"] += misses
+            self.counters["evictions"] += len(evicted)
+            self.counters["evicted_bytes"] += evicted_bytes
+        self._save()
+
+    def metrics(self) -> str:
+        """Return the metrics in the Prometheus text format."""
+        with self._lock:
+            size = sum(entry.size for entry in self.entries.values())
+            count = len(self.entries)
+            counters = dict(self.counters)
+        compiles = counters["hits"] + counters["misses"]
+        lines = []
+        for name, kind, value in (
+            ("hits_total", "counter", counters["hits"]),
+            ("misses_total", "counter", counters["misses"]),
+            ("hit_ratio", "gauge", counters["hits"] / compiles if compiles else 0),
+            ("evictions_total", "counter", counters["evictions"]),
+            ("evicted_bytes_total", "counter", counters["evicted_bytes"]),
+            ("bytes", "gauge", size),
+            ("budget_bytes", "gauge", self.budget),
+            ("entries", "gauge", count),
+        ):
+            lines.append(f"# TYPE overleaf_compile_cache_{name} {kind}")
+            lines.append(f"overleaf_compile_cache_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _handler(janitor: Janitor) -> type[http.server.BaseHTTPRequestHandler]:
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):  # noqa: N802
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = janitor.metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # noqa: A002
+            pass
+
+    return MetricsHandler
+
+
+def main():
+    """Run the janitor until Pebble stops it."""
+    parser = argparse.ArgumentParser(description="Keep the compile cache under its budget.")
+    parser.add_argument("--root", required=True, help="the directory above clsi's compiles")
+    parser.add_argument("--budget", type=int, default=0, help="the size budget, in bytes")
+    parser.add_argument("--interval", type=int, default=60, help="seconds between scans")
+    parser.add_argument("--port", type=int, required=True, help="the port to serve metrics on")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    janitor = Janitor(args.root, args.budget)
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", args.port), _handler(janitor))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    while True:
+        try:
+            janitor.run_once()
+        except OSError as e:
+            logger.error("Compile cache scan failed: %s", e)
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
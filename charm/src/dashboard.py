@@ -0,0 +1,184 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+"""The Grafana dashboard for the Overleaf services, built from the catalogue.
+
+The charm gives Grafana src/grafana_dashboards/overleaf.json, through the
+grafana_dashboard library; run this module to build it again when the
+catalogue or the panels change.
+
+The metric names are those the services report through @overleaf/metrics:
+timers are summaries in milliseconds with a "quantile" label (and a _count),
+and the process and Node metrics come from prom-client's defaults. Every
+series carries the "service" and "pebble_service" labels of its scrape job.
+"""
+
+import json
+import pathlib
+from typing import Any, Iterator
+
+import services
+
+TITLE = "Overleaf"
+UID = "overleaf-k8s"
+# Grafana's datasource variable; the grafana_dashboard consumer defines it.
+DATASOURCE = "${prometheusds}"
+PANEL_WIDTH = 12
+PANEL_HEIGHT = 8
+DASHBOARD_FILE = pathlib.Path(__file__).parent / "grafana_dashboards" / "overleaf.json"
+
+
+def _panel(title: str, unit: str, *targets: tuple[str, str]) -> dict[str, Any]:
+    """Return a time series panel, without its position."""
+    return {
+        "type": "timeseries",
+        "title": title,
+        "datasource": DATASOURCE,
+        "fieldConfig": {"defaults": {"unit": unit}, "overrides": []},
+        "targets": [
+            {"expr": expr, "legendFormat": legend, "refId": chr(ord("A") + i)}
+            for i, (expr, legend) in enumerate(targets)
+        ],
+    }
+
+
+def _row(title: str) -> dict[str, Any]:
+    return {"type": "row", "title": title, "collapsed": False, "panels": []}
+
+
+def _overview() -> Iterator[dict[str, Any]]:
+    """Yield the panels on the traffic through the services."""
+    yield _row("Traffic")
+    yield _panel(
+        "Web requests by route",
+        "reqps",
+        ('sum by (path) (rate(http_request_count{service="web"}[5m]))', "{{path}}"),
+    )
+    yield _panel(
+        "Web p95 latency by route",
+        "ms",
+        ('max by (path) (http_request{service="web", quantile="0.95"})', "{{path}}"),
+    )
+    yield _panel(
+        "Real-time connected clients",
+        "short",
+        ('sum by (juju_unit) (socket_io_clients{service="real_time"})', "{{juju_unit}}"),
+    )
+    yield _panel(
+        "Document updater flush time",
+        "ms",
+        (
+            'max by (juju_unit) (flush_doc{service="document_updater", quantile="0.95"})',
+            "p95 {{juju_unit}}",
+        ),
+    )
+    yield _row("Compiles")
+    yield _panel(
+        "Compile duration",
+        "ms",
+        ('max by (juju_unit) (run_compile{service="clsi", quantile="0.5"})', "p50 {{juju_unit}}"),
+        ('max by (juju_unit) (run_compile{service="clsi", quantile="0.95"})', "p95 {{juju_unit}}"),
+    )
+    yield _panel(
+        "Compile queue",
+        "ms",
+        (
+            'max by (juju_unit) (lock_wait{service="clsi", quantile="0.95"})',
+            "wait p95 {{juju_unit}}",
+        ),
+    )
+    yield _panel(
+        "Compile cache hit ratio",
+        "percentunit",
+        ("avg by (juju_unit) (overleaf_compile_cache_hit_ratio)", "{{juju_unit}}"),
+    )
+    yield _panel(
+        "Compile cache evictions",
+        "bytes",
+        (
+            "sum by (juju_unit) (rate(overleaf_compile_cache_evicted_bytes_total[1h]))",
+            "{{juju_unit}}",
+        ),
+    )
+    yield _row("Connection pools")
+    yield _panel(
+        "MongoDB pool in use",
+        "short",
+        (
+            "sum by (service) (mongodb_pool_size - mongodb_pool_available)",
+            "{{service}}",
+        ),
+        ("sum by (service) (mongodb_pool_waiting)", "{{service}} waiting"),
+    )
+    yield _panel(
+        "Redis connections",
+        "short",
+        ("sum by (service) (redis_connections)", "{{service}}"),
+    )
+
+
+def _service_panels(service: str) -> Iterator[dict[str, Any]]:
+    """Yield the resource panels for one service of the catalogue."""
+    selector = f'service="{service}"'
+    yield _row(service)
+    yield _panel(
+        f"{service} memory (RSS)",
+        "bytes",
+        (f"process_resident_memory_bytes{{{selector}}}", "{{pebble_service}} {{juju_unit}}"),
+    )
+    yield _panel(
+        f"{service} CPU",
+        "percentunit",
+        (
+            f"rate(process_cpu_seconds_total{{{selector}}}[5m])",
+            "{{pebble_service}} {{juju_unit}}",
+        ),
+    )
+    yield _panel(
+        f"{service} event loop lag",
+        "s",
+        (
+            f"nodejs_eventloop_lag_p99_seconds{{{selector}}}",
+            "p99 {{pebble_service}} {{juju_unit}}",
+        ),
+    )
+
+
+def build() -> dict[str, Any]:
+    """Return the dashboard, with a resources row for every service in the catalogue."""
+    panels = list(_overview())
+    for service in services.SERVICES:
+        panels.extend(_service_panels(service.name))
+    x = y = 0
+    for i, panel in enumerate(panels):
+        panel["id"] = i + 1
+        if panel["type"] == "row":
+            y += PANEL_HEIGHT if x else 0
+            panel["gridPos"] = {"h": 1, "w": 2 * PANEL_WIDTH, "x": 0, "y": y}
+            x, y = 0, y + 1
+            continue
+        panel["gridPos"] = {"h": PANEL_HEIGHT, "w": PANEL_WIDTH, "x": x, "y": y}
+        x += PANEL_WIDTH
+        if x >= 2 * PANEL_WIDTH:
+            x, y = 0, y + PANEL_HEIGHT
+    return {
+        "title": TITLE,
+        "uid": UID,
+        "tags": ["overleaf"],
+        "timezone": "browser",
+        "refresh": "30s",
+        "time": {"from": "now-6h", "to": "now"},
+        "schemaVersion": 39,
+        "templating": {"list": []},
+        "panels": panels,
+    }
+
+
+def render() -> str:
+    """Return the dashboard as it is kept in DASHBOARD_FILE."""
+    return json.dumps(build(), indent=2, sort_keys=True) + "\n"
+
+
+if __name__ == "__main__":  # pragma: nocover
+    DASHBOARD_FILE.parent.mkdir(exist_ok=True)
+    DASHBOARD_FILE.write_text(render())
@@ -0,0 +1,173 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+"""Latency instrumentation for the charm's event handlers."""
+
+import collections
+import functools
+import json
+import logging
+import math
+import os
+import pathlib
+import time
+from typing import Any, Callable, Iterator, Optional
+
+import ops
+
+logger = logging.getLogger(__name__)
+
+# Where the records go, in the unit's state directory. Juju keeps that in the
+# unit's agent directory, next to the charm directory that holds the code.
+STATE_DIR = "state"
+STATS_FILE = "hook-stats.jsonl"
+# Rotate the records file once it grows past this size; one older file is kept.
+MAX_BYTES = 512 * 1024
+
+HOOK_TOOLS = "hook-tools"
+PEBBLE = "pebble"
+
+
+class HookStats(ops.Object):
+    """Time every observed handler and count the calls it makes.
+
+    For each handler invocation this records the wall time, the number of
+    Juju hook-tool calls and the number of Pebble API calls, appends the
+    record to a JSON-lines file and logs a one-line summary. The counts are
+    inclusive: a library handler that emits a custom event also counts the
+    calls made by the charm's handler for that event.
+    """
+
+    def __init__(self, charm: ops.CharmBase, path: pathlib.Path):
+        super().__init__(charm, "hook-stats")
+        self.path = path
+        self.calls: collections.Counter[str] = collections.Counter()
+        self._count_calls(charm.model._backend, HOOK_TOOLS)
+        for container in charm.unit.containers.values():
+            self._count_calls(container.pebble, PEBBLE)
+        # Handlers are timed as they are registered, the charm libraries'
+        # included, so this must be set up before anything is observed.
+        self._framework_observe = self.framework.observe
+        self.framework.observe = self.observe  # type: ignore
+
+    def _count_calls(self, target: Any, kind: str):
+        """Count every call to the public methods of target."""
+        for name in dir(target):
+            method = getattr(target, name)
+            if name.startswith("_") or not callable(method):
+                continue
+            setattr(target, name, self._counted(method, kind))
+
+    def _counted(self, method: Callable[..., Any], kind: str) -> Callable[..., Any]:
+        def counted(*args: Any, **kwargs: Any):
+            self.calls[kind] += 1
+            return method(*args, **kwargs)
+
+        return counted
+
+    def observe(self, bound_event: ops.BoundEvent, observer: Callable[[Any], None]):
+        """Observe an event, as ops.Framework.observe does, and time the handler."""
+        # A handler that is observed again is already timed.
+        observer = getattr(observer, "__wrapped__", observer)
+        self._framework_observe(bound_event, observer)
+        instance, method_name = getattr(observer, "__self__"), observer.__name__
+        # The framework looks up handlers by name on the observer at emit
+        # time, so replacing them on the instance is enough to wrap them.
+        if method_name not in vars(instance):
+            name = f"{type(instance).__name__}.{method_name}"
+            setattr(instance, method_name, self._timed(observer, name))
+
+    def _timed(self, handler: Callable[..., None], name: str):
+        @functools.wraps(handler)
+        def timed(*args: Any, **kwargs: Any):
+            event = args[0] if args else None
+            if not isinstance(event, ops.EventBase):
+                # Libraries call some of their handlers themselves, too.
+                return handler(*args, **kwargs)
+            calls = self.calls.copy()
+            start = time.perf_counter()
+            try:
+                handler(*args, **kwargs)
+            finally:
+                self._record(
+                    {
+                        "time": time.time(),
+                        "hook": os.environ.get("JUJU_DISPATCH_PATH", ""),
+                        "event": event.handle.kind,
+                        "handler": name,
+                        "seconds": round(time.perf_counter() - start, 6),
+                        HOOK_TOOLS: self.calls[HOOK_TOOLS] - calls[HOOK_TOOLS],
+                        PEBBLE: self.calls[PEBBLE] - calls[PEBBLE],
+                    }
+                )
+
+        return timed
+
+    def _record(self, record: dict[str, Any]):
+        logger.debug(
+            "%s handled %s in %.1fms (%d hook tool calls, %d Pebble calls)",
+            record["handler"],
+            record["event"],
+            record["seconds"] * 1000,
+            record[HOOK_TOOLS],
+            record[PEBBLE],
+        )
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self.path.exists() and self.path.stat().st_size > MAX_BYTES:
+                self.path.replace(self.path.with_name(self.path.name + ".1"))
+            with self.path.open("a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            # The stats are a diagnostic aid; never fail a hook over them.
+            logger.warning("Unable to write hook stats to %s: %s", self.path, e)
+
+    def records(self) -> Iterator[dict[str, Any]]:
+        """Yield the stored records, oldest first."""
+        for path in (self.path.with_name(self.path.name + ".1"), self.path):
+            try:
+                with path.open() as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                continue
+            for line in lines:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def summary(self, handler: Optional[str] = None) -> dict[str, dict[str, float]]:
+        """Return latency percentiles and mean call counts per handler.
+
+        Args:
+            handler: only report handlers whose name contains this string.
+        """
+        by_handler: dict[str, list[dict[str, Any]]] = collections.defaultdict(list)
+        for record in self.records():
+            if handler and handler not in record["handler"]:
+                continue
+            by_handler[record["handler"]].append(record)
+        summary = {}
+        for name, records in sorted(by_handler.items()):
+            seconds = sorted(record["seconds"] for record in records)
+            summary[name] = {
+                "count": len(records),
+                "p50-ms": _percentile(seconds, 50) * 1000,
+                "p90-ms": _percentile(seconds, 90) * 1000,
+                "p99-ms": _percentile(seconds, 99) * 1000,
+                "max-ms": seconds[-1] * 1000,
+                "mean-hook-tools": sum(r[HOOK_TOOLS] for r in records) / len(records),
+                "mean-pebble": sum(r[PEBBLE] for r in records) / len(records),
+            }
+        return summary
+
+
+def stats_path(charm_dir: pathlib.Path) -> pathlib.Path:
+    """Return where the records go for the charm in charm_dir."""
+    return charm_dir.parent / STATE_DIR / STATS_FILE
+
+
+def _percentile(ordered: list[float], percent: float) -> float:
+    """Return the nearest-rank percentile of an ordered, non-empty list."""
+    rank = math.ceil(percent / 100 * len(ordered))
+    return ordered[max(rank, 1) - 1]
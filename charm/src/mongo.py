@@ -0,0 +1,174 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+"""Building MongoDB connection strings from the database relation data."""
+
+import urllib.parse
+from typing import Mapping, Optional, Sequence
+
+DEFAULT_PORT = 27017
+
+# The connection options that can be tuned per service, and how to check them.
+TUNABLE_OPTIONS = {
+    "maxPoolSize": str.isdigit,
+    "minPoolSize": str.isdigit,
+    "maxIdleTimeMS": str.isdigit,
+    "readPreference": {
+        "primary",
+        "primaryPreferred",
+        "secondary",
+        "secondaryPreferred",
+        "nearest",
+    }.__contains__,
+}
+
+
+class InvalidMongoURIError(ValueError):
+    """The MongoDB connection string is not valid."""
+
+
+def _split_endpoint(endpoint: str) -> tuple[str, str]:
+    """Split "host:port" into the host and the port, which may be empty.
+
+    An IPv6 address takes a port in bracket notation, "[fd00::1]:27017"; a
+    bare one has none.
+
+    Raises:
+        InvalidMongoURIError: if the brackets aren't closed, or are followed
+            by something other than a port.
+    """
+    if endpoint.startswith("["):
+        host, bracket, rest = endpoint[1:].partition("]")
+        if not bracket or (rest and not rest.startswith(":")):
+            raise InvalidMongoURIError(f"invalid endpoint {endpoint!r}")
+        return host, rest[1:]
+    if endpoint.count(":") > 1:
+        return endpoint, ""
+    host, _, port = endpoint.partition(":")
+    return host, port
+
+
+def _format_endpoint(host: str, port: int) -> str:
+    """Return the host and port as they go in a connection string."""
+    return f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+
+
+def parse_endpoints(endpoints: str) -> list[tuple[str, int]]:
+    """Return the (host, port) pairs in a comma-separated list of endpoints.
+
+    Endpoints without a port use the MongoDB default.
+
+    Raises:
+        InvalidMongoURIError: if an endpoint or its port is not valid.
+    """
+    hosts = []
+    for endpoint in endpoints.split(","):
+        endpoint = endpoint.strip()
+        if not endpoint:
+            continue
+        host, port = _split_endpoint(endpoint)
+        if port and not (port.isdigit() and 0 < int(port) < 65536):
+            raise InvalidMongoURIError(f"invalid port {port!r} for {host}")
+        hosts.append((host, int(port) if port else DEFAULT_PORT))
+    return hosts
+
+
+def replica_set(relation_data: Mapping[str, str]) -> Optional[str]:
+    """Return the name of the replica set from the relation data, if there is one.
+
+    This is the "replset" field, or failing that the replicaSet option of the
+    "uris" field.
+    """
+    if relation_data.get("replset"):
+        return relation_data["replset"]
+    # The host list may hold commas, so this can't go through urlsplit.
+    query = relation_data.get("uris", "").partition("?")[2]
+    names = urllib.parse.parse_qs(query).get("replicaSet")
+    return names[0] if names else None
+
+
+def parse_options(value: str) -> dict[str, str]:
+    """Parse connection options given as a query string, such as "maxPoolSize=20".
+
+    Raises:
+        ValueError: if an option can't be tuned, or has an invalid value.
+    """
+    options = {}
+    for name, option in urllib.parse.parse_qsl(value, keep_blank_values=True):
+        if name not in TUNABLE_OPTIONS:
+            raise ValueError(f"{name} can't be set; use one of {', '.join(TUNABLE_OPTIONS)}")
+        if not TUNABLE_OPTIONS[name](option):
+            raise ValueError(f"invalid {name} {option!r}")
+        options[name] = option
+    if int(options.get("minPoolSize", 0)) > int(options.get("maxPoolSize", 1 << 31)):
+        raise ValueError("minPoolSize is larger than maxPoolSize")
+    return options
+
+
+def build_uri(
+    username: str,
+    password: str,
+    hosts: Sequence[tuple[str, int]],
+    database: str,
+    replica_set: Optional[str] = None,
+    options: Optional[Mapping[str, str]] = None,
+) -> str:
+    """Return a connection string that seeds the driver with every host.
+
+    Raises:
+        InvalidMongoURIError: if the result is not a valid connection string.
+    """
+    query = {}
+    if replica_set:
+        query["replicaSet"] = replica_set
+    query["authSource"] = "admin"
+    query.update(options or {})
+    uri = "mongodb://{}:{}@{}/{}?{}".format(
+        urllib.parse.quote(username, safe=""),
+        urllib.parse.quote(password, safe=""),
+        ",".join(_format_endpoint(host, port) for host, port in hosts),
+        urllib.parse.quote(database, safe=""),
+        urllib.parse.urlencode(query),
+    )
+    validate_uri(uri)
+    return uri
+
+
+def validate_uri(uri: str):
+    """Check that uri is a valid mongodb:// connection string.
+
+    Raises:
+        InvalidMongoURIError: if it is not.
+    """
+    scheme, sep, rest = uri.partition("://")
+    if scheme != "mongodb" or not sep:
+        raise InvalidMongoURIError("the scheme must be mongodb://")
+    netloc, _, path_and_query = rest.partition("/")
+    userinfo, at, hostlist = netloc.rpartition("@")
+    if at and (":" not in userinfo or userinfo.startswith(":")):
+        raise InvalidMongoURIError("the credentials must be username:password")
+    if not hostlist:
+        raise InvalidMongoURIError("there must be at least one host")
+    for endpoint in hostlist.split(","):
+        host, port = _split_endpoint(endpoint)
+        if not host or any(c in host for c in "/?#@ "):
+            raise InvalidMongoURIError(f"invalid host {host!r}")
+        if port and not (port.isdigit() and 0 < int(port) < 65536):
+            raise InvalidMongoURIError(f"invalid port {port!r} for {host}")
+    database, _, query = path_and_query.partition("?")
+    if any(c in urllib.parse.unquote(database) for c in '/\\. "$'):
+        raise InvalidMongoURIError(f"invalid database name {database!r}")
+    try:
+        urllib.parse.parse_qs(query, strict_parsing=bool(query))
+    except ValueError as e:
+        raise InvalidMongoURIError(f"invalid options {query!r}") from e
+
+
+def redact(uri: str) -> str:
+    """Return the connection string with the password masked, for logging."""
+    scheme, sep, rest = uri.partition("://")
+    userinfo, at, rest = rest.partition("@")
+    if not at:
+        return uri
+    username = userinfo.partition(":")[0]
+    return f"{scheme}{sep}{username}:***@{rest}"
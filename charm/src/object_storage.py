@@ -0,0 +1,74 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+"""Reading the S3 settings from the s3 relation data."""
+
+import dataclasses
+from typing import Callable, Mapping, Optional
+
+# The data_interfaces convention: a field named "secret-<group>" holds the URI
+# of a Juju secret with more of the fields, such as the credentials.
+SECRET_PREFIX = "secret-"
+
+
+class SecretUnavailableError(Exception):
+    """A secret that the provider's data names can't be read."""
+
+    def __init__(self, uri: str):
+        super().__init__(f"cannot read the S3 secret {uri}")
+        self.uri = uri
+
+
+@dataclasses.dataclass(frozen=True)
+class S3Settings:
+    """Where the object storage is, and how to authenticate to it.
+
+    Attributes:
+        bucket: the bucket the provider gave us. The services each get
+            buckets named after it, such as "<bucket>-user-files".
+        access_key: the access key ID.
+        secret_key: the secret access key.
+        endpoint: the S3 API endpoint, or empty for AWS.
+        region: the region, or empty for the provider's default.
+        path_style: whether buckets are addressed by path rather than by host
+            name, as MinIO and most other stand-ins need.
+    """
+
+    bucket: str
+    access_key: str
+    secret_key: str
+    endpoint: str = ""
+    region: str = ""
+    path_style: bool = False
+
+
+def parse_settings(
+    relation_data: Mapping[str, str], get_secret: Callable[[str], Mapping[str, str]]
+) -> Optional[S3Settings]:
+    """Return the S3 settings from the provider's data, or None if it isn't complete.
+
+    Args:
+        relation_data: the provider application's relation data.
+        get_secret: returns the content of the secret with the given URI.
+
+    Raises:
+        SecretUnavailableError: if get_secret does, for a secret that has been
+            removed or that the charm hasn't been granted.
+    """
+    data = dict(relation_data)
+    for key, uri in relation_data.items():
+        if key.startswith(SECRET_PREFIX) and uri:
+            data.update(get_secret(uri))
+    if not all(data.get(key) for key in ("bucket", "access-key", "secret-key")):
+        return None
+    endpoint = data.get("endpoint", "")
+    # Without an endpoint this is AWS, where virtual-host style is the default.
+    uri_style = data.get("s3-uri-style") or ("path" if endpoint else "host")
+    return S3Settings(
+        bucket=data["bucket"],
+        access_key=data["access-key"],
+        secret_key=data["secret-key"],
+        endpoint=endpoint,
+        region=data.get("region", ""),
+        path_style=uri_style == "path",
+    )
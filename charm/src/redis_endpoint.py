@@ -0,0 +1,96 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+"""A leader-aware view of the Redis endpoints on the redis relation."""
+
+import dataclasses
+from typing import Optional
+
+import ops
+from charms.redis_k8s.v0.redis import RedisRequires
+
+
+@dataclasses.dataclass(frozen=True)
+class RedisEndpoint:
+    """Where the related Redis can be reached.
+
+    Attributes:
+        primary: the host that takes writes: the Redis leader if the provider
+            names one, otherwise the host published by the first unit.
+        replicas: every other host published by the Redis units, sorted.
+        port: the Redis port.
+    """
+
+    primary: str
+    replicas: tuple[str, ...] = ()
+    port: str = "6379"
+
+    @property
+    def url(self) -> str:
+        """The URL of the primary."""
+        return f"redis://{self.primary}:{self.port}"
+
+
+class RedisEndpointRequires(RedisRequires):
+    """The redis requirer, resolving the relation data into a RedisEndpoint.
+
+    The library's relation_data property returns the databag of an arbitrary
+    unit, and every access goes back to the unit agent. This reads all the
+    units and the leader host once, and keeps the result until the relation
+    changes (in a deployed charm, that is for the rest of the dispatch).
+    """
+
+    def __init__(self, charm: ops.CharmBase, relation_name: str = "redis"):
+        super().__init__(charm, relation_name)
+        # A unit leaving may take the primary with it.
+        self.framework.observe(charm.on[relation_name].relation_departed, self._on_relation_broken)
+        self._endpoint: Optional[RedisEndpoint] = None
+        self._resolved = False
+
+    def _on_relation_changed(self, event: ops.RelationEvent):
+        self._resolved = False
+        if event.unit is None:
+            # The library ignores app data changes, but a new leader-host is
+            # a failover.
+            self.charm.on.redis_relation_updated.emit()
+            return
+        super()._on_relation_changed(event)
+
+    def _on_relation_broken(self, event: ops.RelationEvent):
+        self._resolved = False
+        super()._on_relation_broken(event)
+
+    @property
+    def endpoint(self) -> Optional[RedisEndpoint]:
+        """The resolved endpoint, or None if no Redis unit has published one yet."""
+        if not self._resolved:
+            self._endpoint = self._resolve()
+            self._resolved = True
+        return self._endpoint
+
+    @property
+    def url(self) -> Optional[str]:
+        """The URL of the Redis primary."""
+        endpoint = self.endpoint
+        return endpoint.url if endpoint is not None else None
+
+    def _resolve(self) -> Optional[RedisEndpoint]:
+        relation = self.model.get_relation(self.relation_name)
+        if relation is None:
+            return None
+        hosts: list[str] = []
+        port = None
+        for unit in sorted(relation.units, key=lambda unit: int(unit.name.split("/")[1])):
+            data = relation.data[unit]
+            host = data.get("hostname")
+            if not host:
+                continue
+            if host not in hosts:
+                hosts.append(host)
+            port = port or data.get("port")
+        leader_host = relation.data[relation.app].get("leader-host") if relation.app else None
+        if not hosts and not leader_host:
+            return None
+        primary = leader_host or hosts[0]
+        replicas = tuple(sorted(host for host in hosts if host != primary))
+        return RedisEndpoint(primary, replicas, port or "6379")
@@ -0,0 +1,991 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+"""The catalogue of Overleaf services and the Pebble layer built from it."""
+
+import dataclasses
+import functools
+import hashlib
+import shlex
+from typing import AbstractSet, Iterable, Mapping, Optional
+
+import ops
+
+from object_storage import S3Settings
+
+# The environment is built from named groups of variables. Every service gets
+# the "common" group; the catalogue lists which other groups a service needs,
+# so that (for example) a Redis failover only changes the services that
+# actually talk to Redis.
+COMMON = "common"
+MONGO = "mongo"
+REDIS = "redis"
+SESSION = "session"
+WEB_API_CREDENTIALS = "web-api-credentials"
+S3 = "s3"
+
+EnvGroups = Mapping[str, Mapping[str, str]]
+
+# Optional Redis integrations, each taking one kind of traffic off the main
+# Redis, and the prefix of the <prefix>_HOST and <prefix>_PORT variables the
+# Overleaf services read that Redis from. These go in the "redis" group, and
+# fall back to the main Redis when the integration is absent.
+REDIS_ROLES = {
+    "redis-pubsub": "PUBSUB_REDIS",
+    "redis-locks": "LOCK_REDIS",
+    "redis-sessions": "SESSIONS_REDIS",
+    "redis-cache": "WEB_REDIS",
+}
+
+# MongoDB connection options by the kind of load a service puts on the
+# database. Options can be overridden per service with the mongo-options config.
+MONGO_FRONTEND = (
+    ("maxPoolSize", "100"),
+    ("minPoolSize", "5"),
+    ("maxIdleTimeMS", "300000"),
+    ("readPreference", "primary"),
+)
+MONGO_BACKEND = (
+    ("maxPoolSize", "50"),
+    ("minPoolSize", "2"),
+    ("maxIdleTimeMS", "300000"),
+    ("readPreference", "primary"),
+)
+MONGO_LIGHT = (
+    ("maxPoolSize", "10"),
+    ("minPoolSize", "0"),
+    ("maxIdleTimeMS", "60000"),
+    ("readPreference", "primary"),
+)
+# For the light services whose reads may lag a write by a moment, such as
+# contacts and notifications. Docstore stays on the primary: document updater
+# reads a doc back from it right after flushing it, and a secondary behind on
+# that write would hand back the older version.
+MONGO_LIGHT_SECONDARY = (*MONGO_LIGHT[:-1], ("readPreference", "secondaryPreferred"))
+
+
+# The share of the container's memory limit given to the Node heaps; the rest
+# is for everything else in the container, such as the LaTeX processes clsi
+# runs. Each enabled service gets a part of it in proportion to its weight.
+HEAP_FRACTION = 0.75
+MIN_HEAP_MB = 128
+
+# The port clsi listens on; web assumes it, whatever CLSI_HOST is.
+CLSI_PORT = 3013
+
+# A web application with compile workers sends its compiles to the clsi
+# router, an nginx in the same container on clsi's port. It sends all the
+# requests for a project to the same compile unit, by a hash of the project ID,
+# as the output files of a compile are only on the unit that ran it.
+CLSI_ROUTER = "clsi-router"
+CLSI_ROUTER_CONFIG = "/etc/overleaf/charm-clsi-router.conf"
+
+# A service that runs as several worker processes gets a front, an nginx in
+# the same container that listens on the service's port and spreads the
+# requests across the workers.
+FRONT = "front"
+FRONT_CONFIG = "/etc/overleaf/charm-front.conf"
+MAX_WORKERS = 32
+
+# The persistent data, on the "data" storage mounted at /var/lib/overleaf,
+# laid out as the image's 100_make_overleaf_data_dirs.sh makes it.
+DATA_PATH = "/var/lib/overleaf/data"
+TMP_PATH = "/var/lib/overleaf/tmp"
+DATA_DIRS = {
+    DATA_PATH: ("user_files", "compiles", "output", "cache", "template_files", "history"),
+    TMP_PATH: ("projectHistories", "dumpFolder", "uploads"),
+}
+
+# The optional "compile-scratch" storage, on a tmpfs or local SSD pool, takes
+# clsi's working directories off the data storage. clsi then runs with a
+# settings file that moves them there, and otherwise loads the image's.
+SCRATCH_PATH = "/var/lib/overleaf/scratch"
+SCRATCH_DIRS = {"compilesDir": "compiles", "outputDir": "output", "clsiCacheDir": "cache"}
+IMAGE_SETTINGS = "/etc/overleaf/settings.js"
+SCRATCH_SETTINGS = "/etc/overleaf/charm-clsi-settings.js"
+
+# The janitor that keeps clsi's per-project directories under a size budget,
+# run by Pebble alongside clsi from the copy the charm pushes.
+COMPILE_CACHE = "compile-cache"
+COMPILE_CACHE_SCRIPT = "/usr/local/lib/overleaf-charm/compile_cache.py"
+COMPILE_CACHE_PORT = 9157
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+# The metrics proxy: an nginx that serves the /metrics of each of the unit's
+# Pebble services as /metrics/<service> on one port, as most of the services
+# only listen on localhost. Prometheus scrapes that on every unit; a service
+# that the unit doesn't run has no metrics there.
+METRICS = "metrics"
+METRICS_CONFIG = "/etc/overleaf/charm-metrics.conf"
+METRICS_PORT = 9102
+
+# The levels the services' LOG_LEVEL takes. Their logs go to every Loki on the
+# logging integration, through a Pebble log target for each. Pebble labels
+# each line with the service it came from.
+LOG_LEVELS = ("debug", "info", "warn", "error", "fatal")
+
+# Web's database migrations, as the image's 900_run_web_migrations.sh runs
+# them on every container start. The charm runs them from the leader instead,
+# once for each set of migrations the image ships.
+MIGRATIONS_DIR = "/overleaf/services/web/migrations"
+MIGRATIONS_COMMAND = ("npm", "run", "migrations", "--", "migrate", "-t", "server-ce")
+MIGRATIONS_TIMEOUT = 30 * 60
+
+# The check that web is serving, which gates the unit's ingress. Unlike the
+# checks of the individual services, this is at the "ready" level, and fails on
+# the first failure, so that the charm hears about a slow start.
+WEB_READY = "web-ready"
+CHECK_PERIOD_SECONDS = 10
+CHECK_PERIOD = f"{CHECK_PERIOD_SECONDS}s"
+CHECK_TIMEOUT = "3s"
+CHECK_THRESHOLD = 3
+# web and web_api load and compile all of web's modules before they listen,
+# which on a cold start with a small CPU quota takes minutes; with the default
+# threshold Pebble would restart them before they ever got there.
+SLOW_START_CHECK_THRESHOLD = 30
+
+
+class ConfigError(ValueError):
+    """The charm configuration is not valid."""
+
+
+@dataclasses.dataclass(frozen=True)
+class CompileCache:
+    """How the compile cache janitor runs.
+
+    Attributes:
+        root: the directory that holds clsi's compiles and output directories.
+        budget: the size the cache is kept under, in bytes, or 0 for a share
+            of the volume it is on.
+    """
+
+    root: str = DATA_PATH
+    budget: int = 0
+
+
+@dataclasses.dataclass(frozen=True)
+class NodeRuntime:
+    """How the services' Node.js processes are run.
+
+    Attributes:
+        memory_limit: the container's memory limit in bytes, if it has one.
+        options: extra Node flags for each service, by service name.
+        threadpool_sizes: UV_THREADPOOL_SIZE for each service, by service
+            name, overriding the catalogue.
+        workers: the number of worker processes for each service that runs
+            more than one, by service name.
+    """
+
+    memory_limit: Optional[int] = None
+    options: tuple[tuple[str, str], ...] = ()
+    threadpool_sizes: tuple[tuple[str, int], ...] = ()
+    workers: tuple[tuple[str, int], ...] = ()
+
+
+@dataclasses.dataclass(frozen=True)
+class OverleafService:
+    """An Overleaf service, as run by one of the scripts in overleaf/server-ce/runit.
+
+    Attributes:
+        name: the name of the Pebble service.
+        summary: a short description of the service.
+        app: the path of the service's app.js, relative to /overleaf/services.
+        env_groups: the environment groups, other than "common", that the
+            service needs.
+        environment: variables specific to the service, overlaid on the groups.
+        mongo_options: the default MongoDB connection options for the service.
+        mongo_pool_variable: the variable the service sizes its MongoDB pool
+            from, if its client options override the connection string's
+            maxPoolSize.
+        singleton: whether only one unit of the application may run the
+            service. The other units reach it on that unit instead.
+        s3_prefix: for a service that can keep its data in object storage,
+            the prefix of the variables that configure it. With an s3
+            integration, such a service is no longer a singleton.
+        s3_buckets: the variables that name the service's buckets, and the
+            suffix of each bucket's name.
+        host_variable: the variable the other services find this one with.
+        heap_weight: the service's share of the memory for Node heaps,
+            relative to the other services.
+        threadpool_size: the default UV_THREADPOOL_SIZE, or 0 for Node's own.
+        port: the port the service listens on. Its health check is a GET of
+            /status on it.
+        check_threshold: how many of the health checks in a row must fail
+            for Pebble to restart the service.
+        worker_ports: the first of the ports the workers listen on, or 0 if
+            the service can only run as one process.
+        after: the services this one calls as soon as it starts, so that
+            Pebble starts them first. Services that don't depend on each
+            other start in parallel.
+    """
+
+    name: str
+    summary: str
+    app: str
+    env_groups: tuple[str, ...] = ()
+    environment: tuple[tuple[str, str], ...] = (("LISTEN_ADDRESS", "127.0.0.1"),)
+    mongo_options: tuple[tuple[str, str], ...] = MONGO_LIGHT
+    mongo_pool_variable: str = ""
+    singleton: bool = False
+    s3_prefix: str = ""
+    s3_buckets: tuple[tuple[str, str], ...] = ()
+    host_variable: str = ""
+    heap_weight: int = 1
+    threadpool_size: int = 0
+    port: int = 0
+    check_threshold: int = CHECK_THRESHOLD
+    worker_ports: int = 0
+    after: tuple[str, ...] = ()
+
+
+# The backend services that web (and web_api) call.
+WEB_DEPENDENCIES = (
+    "docstore",
+    "filestore",
+    "history_v1",
+    "chat",
+    "contacts",
+    "notifications",
+    "spelling",
+    "clsi",
+    "project_history",
+    "document_updater",
+)
+
+# The services are in overleaf/server-ce/runit. In each run script, the
+# relevant lines are the last 3:
+#   source /etc/overleaf/env.sh
+# This one holds the common variables.
+#   export LISTEN_ADDRESS=127.0.0.1
+# This one holds the variables specific for the service.
+#   exec /sbin/setuser www-data /usr/bin/node $NODE_PARAMS /overleaf/services/chat/app.js >> /var/log/overleaf/chat.log 2>&1
+# This one has the user, 'www-data', and the actual command. $NODE_PARAMS is
+# built from the NodeRuntime instead.
+#
+# The catalogue is in dependency order: the backing services first, then the
+# ones that talk to them, and web, the entry point, last.
+SERVICES: tuple[OverleafService, ...] = (
+    OverleafService(
+        "docstore", "docstore", "docstore", (MONGO,), mongo_options=MONGO_BACKEND, port=3016
+    ),
+    # Singletons only listen on every interface when other units reach them
+    # on the unit that runs them; the charm overlays that as "common/<name>".
+    OverleafService(
+        "filestore",
+        "filestore",
+        "filestore",
+        (S3,),
+        singleton=True,
+        s3_prefix="OVERLEAF_FILESTORE",
+        s3_buckets=(
+            ("OVERLEAF_FILESTORE_USER_FILES_BUCKET_NAME", "user-files"),
+            ("OVERLEAF_FILESTORE_TEMPLATE_FILES_BUCKET_NAME", "template-files"),
+        ),
+        host_variable="FILESTORE_HOST",
+        port=3009,
+        # filestore's work is mostly disk I/O, which Node does on libuv threads.
+        threadpool_size=16,
+    ),
+    # TODO: history_v1 doesn't really need all of what's in common, but does
+    # need the Mongo settings.
+    OverleafService(
+        "history_v1",
+        "history v1",
+        "history-v1",
+        (MONGO, REDIS, S3),
+        environment=(
+            ("LISTEN_ADDRESS", "127.0.0.1"),
+            ("NODE_CONFIG_DIR", "/overleaf/services/history-v1/config"),
+        ),
+        mongo_options=MONGO_BACKEND,
+        singleton=True,
+        s3_prefix="OVERLEAF_HISTORY",
+        s3_buckets=(
+            ("OVERLEAF_HISTORY_PROJECT_BLOBS_BUCKET", "project-blobs"),
+            ("OVERLEAF_HISTORY_CHUNKS_BUCKET", "chunks"),
+        ),
+        host_variable="HISTORY_V1_HOST",
+        port=3100,
+    ),
+    OverleafService("chat", "chat", "chat", (MONGO,), port=3010),
+    OverleafService(
+        "contacts",
+        "contacts",
+        "contacts",
+        (MONGO,),
+        mongo_options=MONGO_LIGHT_SECONDARY,
+        port=3036,
+    ),
+    OverleafService(
+        "notifications",
+        "notifications",
+        "notifications",
+        (MONGO,),
+        mongo_options=MONGO_LIGHT_SECONDARY,
+        port=3042,
+    ),
+    OverleafService("spelling", "spelling", "spelling", (MONGO,), port=3005),
+    OverleafService("clsi", "clsi", "clsi", heap_weight=2, port=CLSI_PORT),
+    OverleafService(
+        "project_history",
+        "project history",
+        "project-history",
+        (MONGO, REDIS),
+        mongo_options=MONGO_BACKEND,
+        singleton=True,
+        host_variable="PROJECT_HISTORY_HOST",
+        port=3054,
+        after=("history_v1",),
+    ),
+    OverleafService(
+        "document_updater",
+        "document updater",
+        "document-updater",
+        (MONGO, REDIS),
+        mongo_options=MONGO_BACKEND,
+        heap_weight=2,
+        port=3003,
+        after=("docstore", "project_history"),
+    ),
+    OverleafService(
+        "real_time",
+        "real time",
+        "real-time",
+        (REDIS, SESSION),
+        heap_weight=2,
+        port=3026,
+        after=("document_updater", "web_api"),
+    ),
+    OverleafService(
+        "web_api",
+        "web api",
+        "web",
+        (MONGO, REDIS, SESSION, WEB_API_CREDENTIALS),
+        environment=(
+            ("LISTEN_ADDRESS", "127.0.0.1"),
+            ("ENABLED_SERVICES", "api"),
+            ("METRICS_APP_NAME", "web-api"),
+        ),
+        mongo_options=MONGO_FRONTEND,
+        # Web passes its pool size to the driver as a client option, which
+        # takes precedence over the one in the connection string.
+        mongo_pool_variable="MONGO_POOL_SIZE",
+        heap_weight=2,
+        port=3000,
+        check_threshold=SLOW_START_CHECK_THRESHOLD,
+        worker_ports=4200,
+        after=WEB_DEPENDENCIES,
+    ),
+    OverleafService(
+        "web",
+        "web",
+        "web",
+        (MONGO, REDIS, SESSION, WEB_API_CREDENTIALS),
+        environment=(
+            ("LISTEN_ADDRESS", "0.0.0.0"),
+            ("ENABLED_SERVICES", "web"),
+            ("WEB_PORT", "4000"),
+        ),
+        mongo_options=MONGO_FRONTEND,
+        mongo_pool_variable="MONGO_POOL_SIZE",
+        heap_weight=4,
+        port=4000,
+        check_threshold=SLOW_START_CHECK_THRESHOLD,
+        worker_ports=4100,
+        after=WEB_DEPENDENCIES,
+    ),
+)
+
+SERVICE_NAMES = tuple(service.name for service in SERVICES)
+SERVICES_BY_NAME = {service.name: service for service in SERVICES}
+
+# The values of the role config, and the services each runs. A "web"
+# application sends its compiles to a related "compile" application.
+FULL = "full"
+WEB = "web"
+COMPILE = "compile"
+ROLE_SERVICES = {
+    FULL: frozenset(SERVICE_NAMES),
+    WEB: frozenset(SERVICE_NAMES) - {"clsi"},
+    COMPILE: frozenset({"clsi"}),
+}
+
+
+def start_order(name: str) -> int:
+    """Return where a Pebble service comes in the order the services start in.
+
+    A worker starts where the service it is part of would, and the front,
+    the compile cache janitor and the metrics proxy after all the services.
+    The clsi router starts where clsi would, ahead of web.
+    """
+    if name in (FRONT, COMPILE_CACHE, METRICS):
+        return len(SERVICES)
+    if name == CLSI_ROUTER:
+        name = "clsi"
+    if name not in SERVICES_BY_NAME:
+        name = name.rpartition("-")[0]
+    return SERVICE_NAMES.index(name) if name in SERVICES_BY_NAME else -1
+
+
+def service_environment(
+    plan_services: Mapping[str, ops.pebble.Service], name: str
+) -> Optional[dict[str, str]]:
+    """Return the environment a service runs with, or None if it isn't in the plan.
+
+    A service that runs as several workers gives that of its first worker.
+    """
+    for pebble_name in (name, f"{name}-0"):
+        service = plan_services.get(pebble_name)
+        if service is not None and service.startup == "enabled":
+            return {key: str(value) for key, value in service.environment.items()}
+    return None
+
+
+def role_services(role: str) -> frozenset[str]:
+    """Return the names of the services that units in the role run.
+
+    Raises:
+        ConfigError: if there is no such role.
+    """
+    if role not in ROLE_SERVICES:
+        raise ConfigError(f"role must be one of {', '.join(ROLE_SERVICES)}, not {role!r}")
+    return ROLE_SERVICES[role]
+
+
+def singletons(object_storage: bool) -> list[OverleafService]:
+    """Return the services that only one unit runs.
+
+    With object storage, the services that would otherwise keep their data
+    on that unit's disk run on every unit.
+    """
+    return [s for s in SERVICES if s.singleton and not (object_storage and s.s3_prefix)]
+
+
+def s3_env_groups(settings: S3Settings) -> dict[str, dict[str, str]]:
+    """Return the "s3/<service>" groups that move the services' data to object storage."""
+    groups = {}
+    for service in SERVICES:
+        if not service.s3_prefix:
+            continue
+        prefix = service.s3_prefix
+        environment = {
+            f"{prefix}_BACKEND": "s3",
+            f"{prefix}_S3_ACCESS_KEY_ID": settings.access_key,
+            f"{prefix}_S3_SECRET_ACCESS_KEY": settings.secret_key,
+            f"{prefix}_S3_PATH_STYLE": "true" if settings.path_style else "false",
+        }
+        if settings.endpoint:
+            environment[f"{prefix}_S3_ENDPOINT"] = settings.endpoint
+        if settings.region:
+            environment[f"{prefix}_S3_REGION"] = settings.region
+        for variable, suffix in service.s3_buckets:
+            environment[variable] = f"{settings.bucket}-{suffix}"
+        groups[f"{S3}/{service.name}"] = environment
+    return groups
+
+
+def parse_per_service(value: str) -> dict[str, str]:
+    """Parse a per-service config value into a setting for each service.
+
+    The value is a semicolon-separated list of "service:setting" entries, for
+    example "web:maxPoolSize=200; docstore:readPreference=secondaryPreferred".
+
+    Raises:
+        ConfigError: if an entry is malformed or names an unknown service.
+    """
+    settings = {}
+    for entry in value.split(";"):
+        if not entry.strip():
+            continue
+        name, sep, setting = entry.partition(":")
+        name = name.strip()
+        if not sep:
+            raise ConfigError(f"{entry.strip()!r} is not service:setting")
+        if name not in SERVICES_BY_NAME:
+            raise ConfigError(f"unknown service {name!r}")
+        settings[name] = setting.strip()
+    return settings
+
+
+def parse_size(value: str) -> int:
+    """Parse a size such as "20G" into bytes; an empty value is 0.
+
+    Raises:
+        ConfigError: if the value isn't a whole number with an optional K, M,
+            G or T suffix.
+    """
+    value = value.strip().upper().removesuffix("B")
+    number, unit = (value[:-1], value[-1]) if value[-1:].isalpha() else (value, "")
+    if not value:
+        return 0
+    if not number.isdigit() or unit not in SIZE_UNITS:
+        raise ConfigError(f"invalid size {value!r}")
+    return int(number) * SIZE_UNITS[unit]
+
+
+def node_runtime(
+    memory_limit: Optional[int],
+    node_options: str = "",
+    threadpool_sizes: str = "",
+    cpu_quota: float = 0,
+    workers: str = "",
+) -> NodeRuntime:
+    """Return the Node runtime from the container's limits and the charm config.
+
+    Args:
+        memory_limit: the container's memory limit in bytes, if it has one.
+        node_options: the node-options config, Node flags per service.
+        threadpool_sizes: the uv-threadpool-size config, a size per service.
+        cpu_quota: the container's CPU quota in cores, or 0 if it has none.
+        workers: the workers config, a number of workers per service. Services
+            that can run as several workers default to one per core of the
+            quota, or to one if there is no quota.
+
+    Raises:
+        ConfigError: if a config value is invalid.
+    """
+    options = {}
+    for name, value in parse_per_service(node_options).items():
+        try:
+            flags = shlex.split(value)
+        except ValueError as e:
+            raise ConfigError(f"node-options for {name}: {e}") from e
+        if not all(flag.startswith("--") for flag in flags):
+            raise ConfigError(f"node-options for {name} must all be --flags")
+        options[name] = shlex.join(flags)
+    sizes = {}
+    for name, value in parse_per_service(threadpool_sizes).items():
+        # libuv caps the pool at 1024 threads.
+        if not value.isdigit() or not 0 < int(value) <= 1024:
+            raise ConfigError(f"uv-threadpool-size for {name} must be from 1 to 1024")
+        sizes[name] = int(value)
+    default_workers = min(max(int(cpu_quota), 1), MAX_WORKERS)
+    counts = {service.name: default_workers for service in SERVICES if service.worker_ports}
+    for name, value in parse_per_service(workers).items():
+        if not SERVICES_BY_NAME[name].worker_ports:
+            raise ConfigError(f"{name} can only run as one process")
+        if not value.isdigit() or not 0 < int(value) <= MAX_WORKERS:
+            raise ConfigError(f"workers for {name} must be from 1 to {MAX_WORKERS}")
+        counts[name] = int(value)
+    return NodeRuntime(
+        memory_limit,
+        tuple(sorted(options.items())),
+        tuple(sorted(sizes.items())),
+        tuple(sorted((name, count) for name, count in counts.items() if count > 1)),
+    )
+
+
+def _node_params(
+    service: OverleafService, runtime: NodeRuntime, total_weight: int
+) -> tuple[str, dict[str, str]]:
+    """Return the Node flags and environment for the service."""
+    flags = dict(runtime.options).get(service.name, "")
+    if runtime.memory_limit and "--max-old-space-size" not in flags:
+        share = runtime.memory_limit * HEAP_FRACTION * service.heap_weight / total_weight
+        heap_mb = max(int(share) >> 20, MIN_HEAP_MB)
+        flags = f"--max-old-space-size={heap_mb} {flags}".strip()
+    environment = {}
+    threadpool_size = dict(runtime.threadpool_sizes).get(service.name, service.threadpool_size)
+    if threadpool_size:
+        environment["UV_THREADPOOL_SIZE"] = str(threadpool_size)
+    return flags, environment
+
+
+def _worker_names(service: OverleafService, runtime: NodeRuntime) -> list[str]:
+    """Return the names of the Pebble services the service runs as."""
+    count = dict(runtime.workers).get(service.name, 1)
+    if count == 1:
+        return [service.name]
+    return [f"{service.name}-{i}" for i in range(count)]
+
+
+def render_log_targets(
+    endpoints: Iterable[str], labels: Mapping[str, str]
+) -> dict[str, ops.pebble.LogTargetDict]:
+    """Return the Pebble log targets that send all the services' logs to Loki.
+
+    Each target is named after its URL, so that it keeps its name however
+    the other Loki units come and go.
+
+    Args:
+        endpoints: the push URLs of the Loki units.
+        labels: the labels to put on every line, such as the Juju topology.
+    """
+    return {
+        f"loki-{hashlib.sha256(url.encode()).hexdigest()[:12]}": {
+            "override": "replace",
+            "type": "loki",
+            "location": url,
+            "services": ["all"],
+            "labels": dict(labels),
+        }
+        for url in sorted(endpoints)
+    }
+
+
+def render_scratch_settings() -> str:
+    """Return the clsi settings that put its working directories on the scratch storage."""
+    lines = [
+        "// Written by the overleaf-k8s charm; changes will be overwritten.",
+        f"const settings = require('{IMAGE_SETTINGS}')",
+        "settings.path = {",
+        "  ...settings.path,",
+    ]
+    lines += [f"  {key}: '{SCRATCH_PATH}/{name}'," for key, name in SCRATCH_DIRS.items()]
+    lines += ["}", "module.exports = settings", ""]
+    return "\n".join(lines)
+
+
+def render_front_config(layer: ops.pebble.Layer) -> str:
+    """Return the nginx configuration for the front of the layer's workers."""
+    lines = [
+        "# Written by the overleaf-k8s charm; changes will be overwritten.",
+        "daemon off;",
+        "worker_processes auto;",
+        "pid /tmp/charm-front.pid;",
+        "error_log stderr warn;",
+        "events { worker_connections 4096; }",
+        "http {",
+        "    access_log off;",
+        "    client_body_temp_path /tmp/charm-front-body;",
+        "    proxy_temp_path /tmp/charm-front-proxy;",
+        "    fastcgi_temp_path /tmp/charm-front-fastcgi;",
+        "    uwsgi_temp_path /tmp/charm-front-uwsgi;",
+        "    scgi_temp_path /tmp/charm-front-scgi;",
+        "    client_max_body_size 50m;",
+        "    map $http_upgrade $connection_upgrade { default upgrade; '' close; }",
+    ]
+    for service in SERVICES:
+        workers = [
+            worker
+            for name, worker in layer.services.items()
+            if service.worker_ports
+            and name.rpartition("-")[0] == service.name
+            and worker.startup == "enabled"
+        ]
+        if not workers:
+            continue
+        listen = dict(service.environment).get("LISTEN_ADDRESS", "127.0.0.1")
+        lines.append(f"    upstream {service.name} {{")
+        lines.append("        least_conn;")
+        for worker in workers:
+            lines.append(f"        server 127.0.0.1:{worker.environment['WEB_PORT']};")
+        lines += [
+            "        keepalive 32;",
+            "    }",
+            "    server {",
+            f"        listen {listen}:{service.port};",
+            "        location / {",
+            f"            proxy_pass http://{service.name};",
+            "            proxy_http_version 1.1;",
+            "            proxy_set_header Upgrade $http_upgrade;",
+            "            proxy_set_header Connection $connection_upgrade;",
+            "            proxy_set_header Host $host;",
+            "            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;",
+            "            proxy_set_header X-Forwarded-Proto $http_x_forwarded_proto;",
+            "            proxy_read_timeout 10m;",
+            "        }",
+            "    }",
+        ]
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def render_clsi_router_config(layer: ops.pebble.Layer) -> str:
+    """Return the nginx configuration for the clsi router of the layer."""
+    units = layer.services[CLSI_ROUTER].environment.get("OVERLEAF_COMPILE_UNITS", "")
+    lines = [
+        "# Written by the overleaf-k8s charm; changes will be overwritten.",
+        "daemon off;",
+        "worker_processes 1;",
+        "pid /tmp/charm-clsi-router.pid;",
+        "error_log stderr warn;",
+        "events { worker_connections 1024; }",
+        "http {",
+        "    access_log off;",
+        "    client_body_temp_path /tmp/charm-clsi-router-body;",
+        "    proxy_temp_path /tmp/charm-clsi-router-proxy;",
+        "    fastcgi_temp_path /tmp/charm-clsi-router-fastcgi;",
+        "    uwsgi_temp_path /tmp/charm-clsi-router-uwsgi;",
+        "    scgi_temp_path /tmp/charm-clsi-router-scgi;",
+        # A compile request carries the project's documents.
+        "    client_max_body_size 100m;",
+        "    map $uri $clsi_project {",
+        "        ~^/project/(?<project>[^/]+) $project;",
+        "        default $uri;",
+        "    }",
+        "    upstream clsi {",
+        "        hash $clsi_project consistent;",
+    ]
+    for unit in filter(None, units.split(",")):
+        lines.append(f"        server {unit}:{CLSI_PORT};")
+    lines += [
+        "        keepalive 16;",
+        "    }",
+        "    server {",
+        f"        listen 127.0.0.1:{CLSI_PORT};",
+        "        location / {",
+        "            proxy_pass http://clsi;",
+        "            proxy_http_version 1.1;",
+        '            proxy_set_header Connection "";',
+        "            proxy_read_timeout 10m;",
+        "        }",
+        "    }",
+        "}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def render_metrics_config(layer: ops.pebble.Layer) -> str:
+    """Return the nginx configuration for the metrics proxy of the layer."""
+    scraped = layer.services[METRICS].environment.get("OVERLEAF_METRICS", "")
+    lines = [
+        "# Written by the overleaf-k8s charm; changes will be overwritten.",
+        "daemon off;",
+        "worker_processes 1;",
+        "pid /tmp/charm-metrics.pid;",
+        "error_log stderr warn;",
+        "events { worker_connections 256; }",
+        "http {",
+        "    access_log off;",
+        "    client_body_temp_path /tmp/charm-metrics-body;",
+        "    proxy_temp_path /tmp/charm-metrics-proxy;",
+        "    fastcgi_temp_path /tmp/charm-metrics-fastcgi;",
+        "    uwsgi_temp_path /tmp/charm-metrics-uwsgi;",
+        "    scgi_temp_path /tmp/charm-metrics-scgi;",
+        "    server {",
+        f"        listen 0.0.0.0:{METRICS_PORT};",
+    ]
+    for entry in filter(None, scraped.split(",")):
+        name, _, port = entry.partition("=")
+        lines.append(
+            f"        location = /metrics/{name} {{ proxy_pass http://127.0.0.1:{port}/metrics; }}"
+        )
+    lines += [
+        "        location / {",
+        "            default_type text/plain;",
+        '            return 200 "";',
+        "        }",
+        "    }",
+        "}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def scrape_jobs(runtime: NodeRuntime, role: str) -> list[dict]:
+    """Return the Prometheus scrape jobs for the services of the application's units.
+
+    There is a job for each Pebble service, workers included, whose targets
+    are the metrics proxies of all the units.
+
+    Raises:
+        ConfigError: if there is no such role.
+    """
+    names = role_services(role)
+    scraped = [
+        (service.name, pebble_name)
+        for service in SERVICES
+        if service.name in names
+        for pebble_name in _worker_names(service, runtime)
+    ]
+    if "clsi" in names:
+        scraped.append((COMPILE_CACHE, COMPILE_CACHE))
+    return [
+        {
+            "job_name": f"overleaf-{pebble_name}",
+            "metrics_path": f"/metrics/{pebble_name}",
+            "static_configs": [
+                {
+                    "targets": [f"*:{METRICS_PORT}"],
+                    "labels": {"service": name, "pebble_service": pebble_name, "role": role},
+                }
+            ],
+        }
+        for name, pebble_name in scraped
+    ]
+
+
+def render_layer(
+    env_groups: EnvGroups,
+    disabled: AbstractSet[str] = frozenset(),
+    runtime: NodeRuntime = NodeRuntime(),
+    compile_cache: CompileCache = CompileCache(),
+    compile_units: tuple[str, ...] = (),
+) -> ops.pebble.Layer:
+    """Return the Pebble layer for the services in the catalogue.
+
+    Args:
+        env_groups: the values of each environment group, by group name. A
+            group named "<group>/<service>" is overlaid on the group for that
+            service only; "common/<service>" is overlaid last, over the
+            service's own variables. Groups that the unit has no values for
+            (such as "mongo" on a compile worker) may be left out.
+        disabled: the services that this unit doesn't run. They are in the
+            layer, so that they replace any earlier definition, but disabled.
+        runtime: the Node flags, heap sizes, threadpool sizes and workers.
+            A service with more than one worker is rendered as one Pebble
+            service per worker, "<service>-<n>", and the layer gets a front.
+        compile_cache: where clsi's directories are, and their size budget.
+            The janitor runs wherever clsi does.
+        compile_units: the addresses of the compile units of a web
+            application, if it has compile workers. The layer then gets a clsi
+            router that spreads the projects across them.
+    """
+    key = tuple(sorted((group, tuple(sorted(env.items()))) for group, env in env_groups.items()))
+    return ops.pebble.Layer(
+        _render_layer(key, frozenset(disabled), runtime, compile_cache, compile_units)
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _render_layer(
+    env_groups: tuple[tuple[str, tuple[tuple[str, str], ...]], ...],
+    disabled: frozenset[str],
+    runtime: NodeRuntime,
+    compile_cache: CompileCache,
+    compile_units: tuple[str, ...],
+) -> ops.pebble.LayerDict:
+    groups = {group: dict(env) for group, env in env_groups}
+    total_weight = (
+        sum(
+            s.heap_weight * len(_worker_names(s, runtime))
+            for s in SERVICES
+            if s.name not in disabled
+        )
+        or 1
+    )
+    services: dict[str, ops.pebble.ServiceDict] = {}
+    checks: dict[str, ops.pebble.CheckDict] = {}
+    scraped = []
+    for service in SERVICES:
+        flags, node_environment = _node_params(service, runtime, total_weight)
+        environment = dict(groups[COMMON])
+        for group in service.env_groups:
+            environment.update(groups.get(group, {}))
+            environment.update(groups.get(f"{group}/{service.name}", {}))
+        environment.update(service.environment)
+        environment.update(groups.get(f"{COMMON}/{service.name}", {}))
+        environment.update(node_environment)
+        node = f"/usr/bin/node {flags}" if flags else "/usr/bin/node"
+        names = _worker_names(service, runtime)
+        startup = "disabled" if service.name in disabled else "enabled"
+        # Only ordering: "requires" would have Pebble start services that
+        # this unit leaves to another, such as the singletons.
+        after = [
+            worker
+            for dependency in service.after
+            for worker in _worker_names(SERVICES_BY_NAME[dependency], runtime)
+        ]
+        for i, name in enumerate(names):
+            port = service.port
+            worker_environment = dict(environment)
+            if len(names) > 1:
+                # The front listens on the service's port instead.
+                port = service.worker_ports + i
+                worker_environment["LISTEN_ADDRESS"] = "127.0.0.1"
+                worker_environment["WEB_PORT"] = str(port)
+            services[name] = {
+                "override": "replace",
+                "summary": service.summary if len(names) == 1 else f"{service.summary} {i}",
+                "command": f"{node} /overleaf/services/{service.app}/app.js",
+                "startup": startup,
+                "after": after,
+                "environment": worker_environment,
+                "user": "www-data",
+                "on-check-failure": {name: "restart"},
+            }
+            checks[name] = _check(
+                startup,
+                {
+                    "threshold": service.check_threshold,
+                    "http": {"url": f"http://127.0.0.1:{port}/status"},
+                },
+            )
+            if startup == "enabled":
+                scraped.append(f"{name}={port}")
+    if runtime.workers:
+        fronted = {name for name, _ in runtime.workers}
+        startup = "disabled" if fronted <= disabled else "enabled"
+        services[FRONT] = {
+            "override": "replace",
+            "summary": "front for the workers of " + ", ".join(sorted(fronted)),
+            "command": f"/usr/sbin/nginx -c {FRONT_CONFIG}",
+            "startup": startup,
+            "after": [
+                worker
+                for fronted_name in sorted(fronted)
+                for worker in _worker_names(SERVICES_BY_NAME[fronted_name], runtime)
+            ],
+            # The workers the front balances across; the config follows from
+            # this, so a change here means the config must be rewritten.
+            "environment": {"OVERLEAF_WORKERS": ",".join(f"{n}={c}" for n, c in runtime.workers)},
+            "user": "www-data",
+            "on-check-failure": {FRONT: "restart"},
+        }
+        port = min(SERVICES_BY_NAME[name].port for name in fronted)
+        checks[FRONT] = _check(startup, {"tcp": {"host": "127.0.0.1", "port": port}})
+    if compile_units:
+        services[CLSI_ROUTER] = {
+            "override": "replace",
+            "summary": "router of the compiles to the compile units",
+            "command": f"/usr/sbin/nginx -c {CLSI_ROUTER_CONFIG}",
+            "startup": "enabled",
+            # The units the router spreads the projects across; the config
+            # follows from this, so a change here means it must be rewritten.
+            "environment": {"OVERLEAF_COMPILE_UNITS": ",".join(compile_units)},
+            "user": "www-data",
+            "on-check-failure": {CLSI_ROUTER: "restart"},
+        }
+        checks[CLSI_ROUTER] = _check("enabled", {"tcp": {"host": "127.0.0.1", "port": CLSI_PORT}})
+    startup = "disabled" if "clsi" in disabled else "enabled"
+    services[COMPILE_CACHE] = {
+        "override": "replace",
+        "summary": "compile cache janitor",
+        "command": (
+            f"/usr/bin/python3 {COMPILE_CACHE_SCRIPT} --root {compile_cache.root}"
+            f" --budget {compile_cache.budget} --port {COMPILE_CACHE_PORT}"
+        ),
+        "startup": startup,
+        "user": "www-data",
+        "on-check-failure": {COMPILE_CACHE: "restart"},
+    }
+    checks[COMPILE_CACHE] = _check(
+        startup, {"http": {"url": f"http://127.0.0.1:{COMPILE_CACHE_PORT}/metrics"}}
+    )
+    if startup == "enabled":
+        scraped.append(f"{COMPILE_CACHE}={COMPILE_CACHE_PORT}")
+    services[METRICS] = {
+        "override": "replace",
+        "summary": "metrics proxy",
+        "command": f"/usr/sbin/nginx -c {METRICS_CONFIG}",
+        "startup": "enabled",
+        # The services the proxy serves the metrics of; the config follows
+        # from this, so a change here means the config must be rewritten.
+        "environment": {"OVERLEAF_METRICS": ",".join(scraped)},
+        "user": "www-data",
+        "on-check-failure": {METRICS: "restart"},
+    }
+    checks[METRICS] = _check("enabled", {"tcp": {"host": "127.0.0.1", "port": METRICS_PORT}})
+    web = SERVICES_BY_NAME["web"]
+    checks[WEB_READY] = _check(
+        "disabled" if web.name in disabled else "enabled",
+        {"level": "ready", "threshold": 1, "http": {"url": f"http://127.0.0.1:{web.port}/status"}},
+    )
+    return {
+        "summary": "Overleaf service",
+        "description": "pebble config layer for Overleaf server",
+        "services": services,
+        "checks": checks,
+    }
+
+
+def _check(startup: str, check: ops.pebble.CheckDict) -> ops.pebble.CheckDict:
+    """Return a health check with the charm's defaults."""
+    return {
+        "override": "replace",
+        "startup": startup,  # type: ignore
+        "period": CHECK_PERIOD,
+        "timeout": CHECK_TIMEOUT,
+        "threshold": CHECK_THRESHOLD,
+        **check,
+    }
@@ -0,0 +1,53 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+"""A snapshot of the relation data the charm works from."""
+
+import dataclasses
+from typing import Mapping, Optional
+
+from object_storage import S3Settings
+from redis_endpoint import RedisEndpoint
+
+
+@dataclasses.dataclass(frozen=True)
+class RelationSnapshot:
+    """The relation data the charm needs, read once per dispatch.
+
+    Every field comes from a Juju hook tool (or a secret lookup), so reading
+    them once and passing the snapshot around keeps the number of round trips
+    to the unit agent down, no matter how many places use the data.
+
+    Attributes:
+        database_related: whether the database integration exists.
+        mongo: the MongoDB relation data (username, password, endpoints, ...).
+        redis_related: whether the redis integration exists.
+        redis: where Redis can be reached, once a Redis unit has said.
+        redis_roles: the Redis for each optional Redis integration that has
+            one, by relation name.
+        ingress_url: the URL the ingress provider gave us.
+        singleton_unit: the unit that runs the singleton services, if the
+            leader has chosen one.
+        has_peers: whether the application has units other than this one.
+        compile_units: the addresses of the compile units a web application
+            sends its compiles to, as they have given them.
+        filestore_url: where a compile worker fetches the project files from,
+            once the web application has said.
+        s3: the object storage for filestore and history_v1, once the s3
+            provider has given its bucket and credentials.
+        loki_endpoints: the push URLs of the Loki units on the logging
+            relation.
+    """
+
+    database_related: bool = False
+    mongo: Mapping[str, str] = dataclasses.field(default_factory=dict)
+    redis_related: bool = False
+    redis: Optional[RedisEndpoint] = None
+    redis_roles: Mapping[str, RedisEndpoint] = dataclasses.field(default_factory=dict)
+    ingress_url: Optional[str] = None
+    singleton_unit: Optional[str] = None
+    has_peers: bool = False
+    compile_units: tuple[str, ...] = ()
+    filestore_url: Optional[str] = None
+    s3: Optional[S3Settings] = None
+    loki_endpoints: tuple[str, ...] = ()
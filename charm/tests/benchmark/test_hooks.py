@@ -0,0 +1,149 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+#
+# Hook latency benchmarks. These drive the charm through ops.testing.Harness,
+# so run fully offline, and fail when a scenario goes over its budget. Run
+# them with `tox -e benchmark`; scale the budgets for slower machines with
+# HOOK_BENCHMARK_BUDGET_SCALE (for example, 2 doubles every budget).
+
+import json
+import os
+import statistics
+import time
+from typing import Callable
+
+import ops
+import ops.testing
+import pytest
+
+import hook_stats
+from charm import PEER_RELATION, OverleafK8sCharm
+
+BUDGET_SCALE = float(os.environ.get("HOOK_BENCHMARK_BUDGET_SCALE", "1"))
+
+
+class Benchmark:
+    """Time individual events and count the Pebble calls they make."""
+
+    def __init__(self, harness: ops.testing.Harness[OverleafK8sCharm]):
+        self.harness = harness
+        self.seconds: list[float] = []
+        self.pebble_calls = 0
+
+    def __call__(self, emit: Callable[[], object]):
+        """Emit an event, and end the dispatch as ops.main would."""
+        calls = self.harness.charm.hook_stats.calls[hook_stats.PEBBLE]
+        start = time.perf_counter()
+        emit()
+        self.harness.framework.commit()
+        self.seconds.append(time.perf_counter() - start)
+        self.pebble_calls += self.harness.charm.hook_stats.calls[hook_stats.PEBBLE] - calls
+
+    def check(self, name: str, mean_ms: float, p95_ms: float, pebble_calls: int):
+        """Report the results, and fail if they exceed the budget."""
+        ordered = sorted(self.seconds)
+        mean = statistics.fmean(ordered) * 1000
+        p95 = ordered[max(int(len(ordered) * 0.95) - 1, 0)] * 1000
+        print(
+            f"\n{name}: {len(ordered)} events, mean {mean:.2f}ms, p95 {p95:.2f}ms, "
+            f"max {ordered[-1] * 1000:.2f}ms, {self.pebble_calls} Pebble calls"
+        )
+        assert mean <= mean_ms * BUDGET_SCALE, f"{name}: mean {mean:.2f}ms over budget"
+        assert p95 <= p95_ms * BUDGET_SCALE, f"{name}: p95 {p95:.2f}ms over budget"
+        assert self.pebble_calls <= pebble_calls, f"{name}: {self.pebble_calls} Pebble calls"
+
+
+@pytest.fixture
+def benchmark(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    return Benchmark(related_harness)
+
+
+def test_cold_start(harness: ops.testing.Harness[OverleafK8sCharm]):
+    bench = Benchmark(harness)
+    harness.set_leader(True)
+    bench(lambda: harness.set_can_connect("community", True))
+    database_id = harness.add_relation("database", "mongodb-k8s")
+    bench(lambda: harness.add_relation_unit(database_id, "mongodb-k8s/0"))
+    bench(
+        lambda: harness.update_relation_data(
+            database_id,
+            "mongodb-k8s",
+            {
+                "username": "overleaf",
+                "password": "secret",
+                "endpoints": "mongodb-k8s-0.mongodb-k8s-endpoints:27017",
+                "database": "overleaf",
+            },
+        )
+    )
+    redis_id = harness.add_relation("redis", "redis-k8s")
+    bench(lambda: harness.add_relation_unit(redis_id, "redis-k8s/0"))
+    bench(
+        lambda: harness.update_relation_data(
+            redis_id, "redis-k8s/0", {"hostname": "redis-k8s-0", "port": "6379"}
+        )
+    )
+    bench(lambda: harness.container_pebble_ready("community"))
+
+    assert harness.model.unit.status == ops.ActiveStatus()
+    # Most of the Pebble calls lay out the data directories on the new storage.
+    # The pod is probed as soon as the container can be reached, and again on
+    # pebble-ready, which can't tell this pod from a replaced one.
+    bench.check("cold start", mean_ms=50, p95_ms=150, pebble_calls=50)
+
+
+def test_redis_relation_changed_storm(benchmark: Benchmark):
+    harness = benchmark.harness
+    redis_id = harness.model.get_relation("redis").id
+    for i in range(100):
+        benchmark(
+            lambda i=i: harness.update_relation_data(redis_id, "redis-k8s/0", {"nonce": str(i)})
+        )
+
+    # Nothing that matters changed, so Pebble isn't even asked for the plan.
+    benchmark.check("100 redis relation-changed", mean_ms=15, p95_ms=30, pebble_calls=0)
+
+
+def test_mongo_credential_rotation(benchmark: Benchmark):
+    harness = benchmark.harness
+    database_id = harness.model.get_relation("database").id
+    for i in range(20):
+        benchmark(
+            lambda i=i: harness.update_relation_data(
+                database_id, "mongodb-k8s", {"password": f"rotated-{i}"}
+            )
+        )
+
+    # Each rotation gets the plan, restarts what uses Mongo, and checks that
+    # the data directories are still there.
+    benchmark.check("20 mongo credential rotations", mean_ms=30, p95_ms=60, pebble_calls=20 * 7)
+
+
+def test_ingress_url_churn(benchmark: Benchmark):
+    harness = benchmark.harness
+    harness.add_network("10.1.2.3")
+    ingress_id = harness.add_relation("ingress", "traefik-k8s")
+    harness.add_relation_unit(ingress_id, "traefik-k8s/0")
+    harness.framework.commit()
+    for i in range(50):
+        url = f"http://overleaf-{i}.example.com/"
+        benchmark(
+            lambda url=url: harness.update_relation_data(
+                ingress_id, "traefik-k8s", {"ingress": json.dumps({"url": url})}
+            )
+        )
+
+    benchmark.check("50 ingress URL changes", mean_ms=15, p95_ms=30, pebble_calls=0)
+
+
+def test_scale_out(benchmark: Benchmark):
+    harness = benchmark.harness
+    peers_id = harness.add_relation(PEER_RELATION, "overleaf-k8s")
+    for i in range(1, 50):
+        benchmark(lambda i=i: harness.add_relation_unit(peers_id, f"overleaf-k8s/{i}"))
+
+    # The singletons stay where they are. The leader's plan only changes when
+    # the first unit joins, to open the singletons to the other units.
+    benchmark.check("scale out to 50 units", mean_ms=15, p95_ms=30, pebble_calls=7)
@@ -0,0 +1,78 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+#
+# Every hook re-imports the charm, so its import time is paid on every
+# dispatch. These use `python -X importtime` to keep it in check.
+
+import os
+import subprocess
+import sys
+
+from test_hooks import BUDGET_SCALE
+
+# Libraries that must not be imported unless the dispatch needs them.
+HEAVY_MODULES = (
+    "pydantic",
+    "charms.data_platform_libs.v0.data_interfaces",
+    "charms.loki_k8s.v1.loki_push_api",
+    "charms.prometheus_k8s.v0.prometheus_scrape",
+    "charms.grafana_k8s.v0.grafana_dashboard",
+)
+
+# Instantiate the charm the way a dispatch would, for the given hook.
+DISPATCH = """
+import ops.testing
+from charm import OverleafK8sCharm
+harness = ops.testing.Harness(OverleafK8sCharm)
+harness.begin()
+"""
+
+
+def _import_times(code: str, dispatch_path: str = "") -> dict[str, int]:
+    """Return the cumulative import time, in microseconds, of each imported module."""
+    env = dict(os.environ, JUJU_DISPATCH_PATH=dispatch_path)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_charm_import_time():
+    times = min((_import_times("import charm") for _ in range(3)), key=lambda t: t["charm"])
+
+    print(f"\nimport charm: {times['charm'] / 1000:.1f}ms")
+    for module in HEAVY_MODULES:
+        assert module not in times
+    assert times["charm"] <= 300_000 * BUDGET_SCALE
+
+
+def test_update_status_skips_heavy_libraries():
+    times = _import_times(DISPATCH, "hooks/update-status")
+    for module in HEAVY_MODULES:
+        assert module not in times
+
+    times = _import_times(DISPATCH, "hooks/database-relation-changed")
+    assert "charms.data_platform_libs.v0.data_interfaces" in times
+    assert "pydantic" not in times
+    assert "charms.loki_k8s.v1.loki_push_api" not in times
+    assert "charms.prometheus_k8s.v0.prometheus_scrape" not in times
+    assert "charms.grafana_k8s.v0.grafana_dashboard" not in times
+
+    times = _import_times(DISPATCH, "hooks/logging-relation-changed")
+    assert "charms.loki_k8s.v1.loki_push_api" in times
+
+    times = _import_times(DISPATCH, "hooks/metrics-endpoint-relation-joined")
+    assert "charms.prometheus_k8s.v0.prometheus_scrape" in times
+
+    times = _import_times(DISPATCH, "hooks/grafana-dashboard-relation-created")
+    assert "charms.grafana_k8s.v0.grafana_dashboard" in times
@@ -0,0 +1,44 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+import ops
+import ops.testing
+import pytest
+
+import hook_stats
+from charm import OverleafK8sCharm
+
+
+@pytest.fixture
+def harness(monkeypatch: pytest.MonkeyPatch, tmp_path):
+    # Keep the hook stats out of the source tree.
+    monkeypatch.setattr(hook_stats, "STATE_DIR", tmp_path)
+    harness = ops.testing.Harness(OverleafK8sCharm)
+    harness.set_model_name("overleaf")
+    harness.begin()
+    yield harness
+    harness.cleanup()
+
+
+@pytest.fixture
+def related_harness(harness: ops.testing.Harness[OverleafK8sCharm]):
+    """Return a harness with the MongoDB and Redis integrations set up."""
+    harness.set_leader(True)
+    database_id = harness.add_relation("database", "mongodb-k8s")
+    harness.add_relation_unit(database_id, "mongodb-k8s/0")
+    harness.update_relation_data(
+        database_id,
+        "mongodb-k8s",
+        {
+            "username": "overleaf",
+            "password": "secret",
+            "endpoints": "mongodb-k8s-0.mongodb-k8s-endpoints:27017",
+            "database": "overleaf",
+        },
+    )
+    redis_id = harness.add_relation("redis", "redis-k8s")
+    harness.add_relation_unit(redis_id, "redis-k8s/0")
+    harness.update_relation_data(
+        redis_id, "redis-k8s/0", {"hostname": "redis-k8s-0.redis-k8s-endpoints", "port": "6379"}
+    )
+    return harness
@@ -3,23 +3,821 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import base64
+import json
+import lzma
+
 import ops
 import ops.testing
 import pytest
 
-from charm import OverleafK8sCharm
-
-
-@pytest.fixture
-def harness():
-    harness = ops.testing.Harness(OverleafK8sCharm)
-    harness.begin()
-    yield harness
-    harness.cleanup()
+import services
+from charm import MIGRATED_KEY, PEER_RELATION, OverleafK8sCharm, _migrations_marker
 
 
-def test_pebble_ready(harness: ops.testing.Harness[OverleafK8sCharm]):
+def test_pebble_ready(related_harness: ops.testing.Harness[OverleafK8sCharm]):
     # Simulate the container coming up and emission of pebble-ready event
-    harness.container_pebble_ready("some-container")
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
     # Ensure we set an ActiveStatus with no message
+    assert related_harness.model.unit.status == ops.ActiveStatus()
+
+
+def test_unchanged_layer_skips_replan(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    charm = related_harness.charm
+    assert charm._stored.layers_applied == 1
+    assert related_harness.model.unit.status == ops.ActiveStatus()
+
+    # A relation flap with identical data must not touch the plan again.
+    redis_id = related_harness.model.get_relation("redis").id
+    related_harness.update_relation_data(redis_id, "redis-k8s/0", {"port": "6379", "flap": "1"})
+    related_harness.framework.commit()
+    assert charm._stored.layers_applied == 1
+    assert charm._stored.layers_skipped == 1
+
+    related_harness.update_relation_data(redis_id, "redis-k8s/0", {"hostname": "redis-k8s-1"})
+    related_harness.framework.commit()
+    assert charm._stored.layers_applied == 2
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.services["web"].environment["OVERLEAF_REDIS_HOST"] == "redis-k8s-1"
+
+
+def test_fixing_the_config_unblocks_the_unit(
+    related_harness: ops.testing.Harness[OverleafK8sCharm],
+):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    assert related_harness.model.unit.status == ops.ActiveStatus()
+
+    related_harness.update_config({"log-level": "verbose"})
+    related_harness.framework.commit()
+    assert isinstance(related_harness.model.unit.status, ops.BlockedStatus)
+
+    # Going back to the inputs the unit last converged on unblocks it.
+    related_harness.update_config({"log-level": "info"})
+    related_harness.framework.commit()
+    assert related_harness.model.unit.status == ops.ActiveStatus()
+
+
+def test_only_changed_services_restart(
+    related_harness: ops.testing.Harness[OverleafK8sCharm], monkeypatch: pytest.MonkeyPatch
+):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    container = related_harness.model.unit.get_container("community")
+    # Simulate drift in a single service's definition.
+    container.add_layer(
+        "Overleaf service",
+        {"services": {"spelling": {"override": "merge", "environment": {"DRIFT": "1"}}}},
+        combine=True,
+    )
+    restarted = []
+    monkeypatch.setattr(container, "restart", lambda *names: restarted.extend(names))
+
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    assert restarted == ["spelling"]
+    plan = related_harness.get_container_pebble_plan("community")
+    assert "DRIFT" not in plan.services["spelling"].environment
+
+
+def test_changed_checks_are_applied(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    container = related_harness.model.unit.get_container("community")
+    # Simulate a check defined by an earlier revision of the charm.
+    container.add_layer(
+        "Overleaf service",
+        {"checks": {"web": {"override": "merge", "threshold": 3}}},
+        combine=True,
+    )
+
+    related_harness.charm.on.upgrade_charm.emit()
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.checks["web"].threshold == 30
+    assert related_harness.charm._stored.layers_applied == 2
+
+
+def test_redis_change_leaves_non_redis_services_running(
+    related_harness: ops.testing.Harness[OverleafK8sCharm], monkeypatch: pytest.MonkeyPatch
+):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    container = related_harness.model.unit.get_container("community")
+    restarted = []
+    monkeypatch.setattr(container, "restart", lambda *names: restarted.extend(names))
+
+    redis_id = related_harness.model.get_relation("redis").id
+    related_harness.update_relation_data(redis_id, "redis-k8s/0", {"hostname": "redis-k8s-1"})
+    related_harness.framework.commit()
+
+    assert restarted == [
+        "history_v1",
+        "project_history",
+        "document_updater",
+        "real_time",
+        "web_api",
+        "web",
+    ]
+    plan = related_harness.get_container_pebble_plan("community")
+    assert "OVERLEAF_REDIS_HOST" not in plan.services["chat"].environment
+
+
+def test_redis_writes_go_to_the_leader(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    redis_id = related_harness.model.get_relation("redis").id
+    related_harness.add_relation_unit(redis_id, "redis-k8s/1")
+    related_harness.update_relation_data(
+        redis_id, "redis-k8s/1", {"hostname": "redis-k8s-1.redis-k8s-endpoints", "port": "6379"}
+    )
+    related_harness.update_relation_data(
+        redis_id, "redis-k8s", {"leader-host": "redis-k8s-1.redis-k8s-endpoints"}
+    )
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    endpoint = related_harness.charm.redis.endpoint
+    assert endpoint.primary == "redis-k8s-1.redis-k8s-endpoints"
+    assert endpoint.replicas == ("redis-k8s-0.redis-k8s-endpoints",)
+    assert related_harness.charm.redis.url == "redis://redis-k8s-1.redis-k8s-endpoints:6379"
+    plan = related_harness.get_container_pebble_plan("community")
+    web = plan.services["web"].environment
+    assert web["OVERLEAF_REDIS_HOST"] == "redis-k8s-1.redis-k8s-endpoints"
+
+    # Failing over to another leader moves the writes with it.
+    related_harness.update_relation_data(
+        redis_id, "redis-k8s", {"leader-host": "redis-k8s-0.redis-k8s-endpoints"}
+    )
+    related_harness.framework.commit()
+    plan = related_harness.get_container_pebble_plan("community")
+    web = plan.services["web"].environment
+    assert web["OVERLEAF_REDIS_HOST"] == "redis-k8s-0.redis-k8s-endpoints"
+
+
+def test_redis_roles_fall_back_to_the_main_redis(
+    related_harness: ops.testing.Harness[OverleafK8sCharm],
+):
+    pubsub_id = related_harness.add_relation("redis-pubsub", "redis-pubsub")
+    related_harness.add_relation_unit(pubsub_id, "redis-pubsub/0")
+    related_harness.update_relation_data(
+        pubsub_id, "redis-pubsub/0", {"hostname": "redis-pubsub-0", "port": "6380"}
+    )
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    env = related_harness.get_container_pebble_plan("community").services["real_time"].environment
+    assert env["PUBSUB_REDIS_HOST"] == "redis-pubsub-0"
+    assert env["PUBSUB_REDIS_PORT"] == "6380"
+    assert env["LOCK_REDIS_HOST"] == "redis-k8s-0.redis-k8s-endpoints"
+    assert env["SESSIONS_REDIS_HOST"] == "redis-k8s-0.redis-k8s-endpoints"
+
+    related_harness.remove_relation(pubsub_id)
+    related_harness.framework.commit()
+
+    env = related_harness.get_container_pebble_plan("community").services["real_time"].environment
+    assert env["PUBSUB_REDIS_HOST"] == "redis-k8s-0.redis-k8s-endpoints"
+
+
+def test_singletons_run_on_one_unit(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    related_harness.set_leader(False)
+    peers_id = related_harness.add_relation(PEER_RELATION, "overleaf-k8s")
+    related_harness.add_relation_unit(peers_id, "overleaf-k8s/1")
+    related_harness.update_relation_data(
+        peers_id, "overleaf-k8s", {"singletons": "overleaf-k8s/1"}
+    )
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    for name in ("filestore", "history_v1", "project_history"):
+        assert plan.services[name].startup == "disabled"
+    assert plan.services["web"].startup == "enabled"
+    env = plan.services["web"].environment
+    assert (
+        env["PROJECT_HISTORY_HOST"]
+        == "overleaf-k8s-1.overleaf-k8s-endpoints.overleaf.svc.cluster.local"
+    )
+    assert env["CLSI_HOST"] == "127.0.0.1"
+
+    # The unit running the singletons leaves, and this one takes over.
+    related_harness.set_leader(True)
+    related_harness.remove_relation_unit(peers_id, "overleaf-k8s/1")
+    related_harness.framework.commit()
+
+    assert related_harness.get_relation_data(peers_id, "overleaf-k8s") == {
+        "singletons": "overleaf-k8s/0"
+    }
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.services["project_history"].startup == "enabled"
+    assert plan.services["web"].environment["PROJECT_HISTORY_HOST"] == "127.0.0.1"
+    container = related_harness.model.unit.get_container("community")
+    assert container.get_service("project_history").is_running()
+    # With no other units, nothing outside the pod needs them.
+    assert plan.services["project_history"].environment["LISTEN_ADDRESS"] == "127.0.0.1"
+
+    # Other units joining don't move them again, but can reach them.
+    related_harness.add_relation_unit(peers_id, "overleaf-k8s/2")
+    related_harness.framework.commit()
+    assert related_harness.get_relation_data(peers_id, "overleaf-k8s") == {
+        "singletons": "overleaf-k8s/0"
+    }
+    plan = related_harness.get_container_pebble_plan("community")
+    for name in ("filestore", "history_v1", "project_history"):
+        assert plan.services[name].environment["LISTEN_ADDRESS"] == "0.0.0.0"
+    assert plan.services["docstore"].environment["LISTEN_ADDRESS"] == "127.0.0.1"
+
+
+def test_s3_moves_filestore_and_history_off_the_singleton_unit(
+    related_harness: ops.testing.Harness[OverleafK8sCharm],
+):
+    related_harness.set_leader(False)
+    peers_id = related_harness.add_relation(PEER_RELATION, "overleaf-k8s")
+    related_harness.add_relation_unit(peers_id, "overleaf-k8s/1")
+    related_harness.update_relation_data(
+        peers_id, "overleaf-k8s", {"singletons": "overleaf-k8s/1"}
+    )
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    # A MinIO stand-in behind s3-integrator, with the credentials in a secret.
+    secret_id = related_harness.add_model_secret(
+        "s3-integrator", {"access-key": "minio", "secret-key": "minio-secret"}
+    )
+    s3_id = related_harness.add_relation("s3", "s3-integrator")
+    related_harness.grant_secret(secret_id, "overleaf-k8s")
+    related_harness.add_relation_unit(s3_id, "s3-integrator/0")
+    related_harness.update_relation_data(
+        s3_id,
+        "s3-integrator",
+        {"bucket": "overleaf", "endpoint": "http://minio:9000", "secret-extra": secret_id},
+    )
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.services["filestore"].startup == "enabled"
+    assert plan.services["history_v1"].startup == "enabled"
+    assert plan.services["project_history"].startup == "disabled"
+    env = plan.services["filestore"].environment
+    assert env["OVERLEAF_FILESTORE_BACKEND"] == "s3"
+    assert env["OVERLEAF_FILESTORE_S3_ENDPOINT"] == "http://minio:9000"
+    assert env["OVERLEAF_FILESTORE_S3_PATH_STYLE"] == "true"
+    assert env["OVERLEAF_FILESTORE_S3_SECRET_ACCESS_KEY"] == "minio-secret"
+    assert env["OVERLEAF_FILESTORE_USER_FILES_BUCKET_NAME"] == "overleaf-user-files"
+    env = plan.services["history_v1"].environment
+    assert env["OVERLEAF_HISTORY_CHUNKS_BUCKET"] == "overleaf-chunks"
+    env = plan.services["web"].environment
+    assert env["FILESTORE_HOST"] == "127.0.0.1"
+    assert "OVERLEAF_FILESTORE_BACKEND" not in env
+
+
+def test_unreadable_s3_secret_blocks(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    # The provider names a secret that the charm hasn't been granted.
+    secret_id = related_harness.add_model_secret(
+        "s3-integrator", {"access-key": "minio", "secret-key": "minio-secret"}
+    )
+    s3_id = related_harness.add_relation("s3", "s3-integrator")
+    related_harness.add_relation_unit(s3_id, "s3-integrator/0")
+    related_harness.update_relation_data(
+        s3_id, "s3-integrator", {"bucket": "overleaf", "secret-extra": secret_id}
+    )
+    related_harness.framework.commit()
+
+    assert related_harness.model.unit.status == ops.BlockedStatus(
+        f"cannot read the S3 secret {secret_id}"
+    )
+    plan = related_harness.get_container_pebble_plan("community")
+    assert "OVERLEAF_FILESTORE_BACKEND" not in plan.services["filestore"].environment
+
+    related_harness.grant_secret(secret_id, "overleaf-k8s")
+    related_harness.update_relation_data(s3_id, "s3-integrator", {"region": "us-east-1"})
+    related_harness.framework.commit()
+
+    assert related_harness.model.unit.status == ops.ActiveStatus()
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.services["filestore"].environment["OVERLEAF_FILESTORE_BACKEND"] == "s3"
+
+
+def test_logs_go_to_loki_without_restarts(
+    related_harness: ops.testing.Harness[OverleafK8sCharm], monkeypatch: pytest.MonkeyPatch
+):
+    related_harness.update_config({"log-level": "debug"})
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    container = related_harness.model.unit.get_container("community")
+    restarted = []
+    monkeypatch.setattr(container, "restart", lambda *names: restarted.extend(names))
+
+    logging_id = related_harness.add_relation("logging", "loki-k8s")
+    urls = [f"http://loki-k8s-{i}.loki-k8s-endpoints:3100/loki/api/v1/push" for i in range(2)]
+    for i, url in enumerate(urls):
+        related_harness.add_relation_unit(logging_id, f"loki-k8s/{i}")
+        related_harness.update_relation_data(
+            logging_id, f"loki-k8s/{i}", {"endpoint": json.dumps({"url": url})}
+        )
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    targets = {target.location: target for target in plan.log_targets.values()}
+    assert set(targets) == set(urls)
+    assert targets[urls[1]].services == ["all"]
+    assert targets[urls[1]].labels["juju_unit"] == "overleaf-k8s/0"
+    assert plan.services["web"].environment["LOG_LEVEL"] == "debug"
+    assert restarted == []
+
+    related_harness.remove_relation_unit(logging_id, "loki-k8s/1")
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    targets = {target.location: target for target in plan.log_targets.values()}
+    assert targets[urls[0]].services == ["all"]
+    assert targets[urls[1]].services == ["-all"]
+    assert restarted == []
+
+
+def test_metrics_endpoint(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    related_harness.update_config({"workers": "web:2"})
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    related_harness.add_network("10.1.2.3")
+    metrics_id = related_harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    related_harness.add_relation_unit(metrics_id, "prometheus-k8s/0")
+    related_harness.framework.commit()
+
+    unit_data = related_harness.get_relation_data(metrics_id, "overleaf-k8s/0")
+    assert unit_data["prometheus_scrape_unit_address"] == "10.1.2.3"
+    app_data = related_harness.get_relation_data(metrics_id, "overleaf-k8s")
+    jobs = {job["job_name"]: job for job in json.loads(app_data["scrape_jobs"])}
+    assert "overleaf-web-1" in jobs
+    assert "overleaf-compile-cache" in jobs
+    assert jobs["overleaf-docstore"]["metrics_path"] == "/metrics/docstore"
+    assert jobs["overleaf-docstore"]["static_configs"][0] == {
+        "targets": [f"*:{services.METRICS_PORT}"],
+        "labels": {"service": "docstore", "pebble_service": "docstore", "role": "full"},
+    }
+    rules = json.loads(app_data["alert_rules"])["groups"][0]["rules"]
+    assert rules[0]["alert"] == "OverleafRequestLatencyHigh"
+    assert rules[0]["labels"]["juju_application"] == "overleaf-k8s"
+    assert "%%juju_topology%%" not in app_data["alert_rules"]
+
+    container = related_harness.model.unit.get_container("community")
+    config = container.pull(services.METRICS_CONFIG).read()
+    assert "location = /metrics/web-1 { proxy_pass http://127.0.0.1:4101/metrics; }" in config
+    assert "location = /metrics/docstore { proxy_pass http://127.0.0.1:3016/metrics; }" in config
+
+
+def test_grafana_dashboard(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    dashboard_id = related_harness.add_relation("grafana-dashboard", "grafana-k8s")
+    related_harness.add_relation_unit(dashboard_id, "grafana-k8s/0")
+    related_harness.framework.commit()
+
+    app_data = related_harness.get_relation_data(dashboard_id, "overleaf-k8s")
+    template = json.loads(app_data["dashboards"])["templates"]["file:overleaf"]
+    content = json.loads(lzma.decompress(base64.b64decode(template["content"])))
+    assert content["title"] == "Overleaf"
+    assert template["juju_topology"]["application"] == "overleaf-k8s"
+
+
+def test_scrape_jobs_follow_the_cpu_quota(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    metrics_id = related_harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    container = related_harness.model.unit.get_container("community")
+    related_harness.set_can_connect(container, True)
+    container.push("/sys/fs/cgroup/cpu.max", "200000 100000\n", make_dirs=True)
+    # Pebble is not up yet when pebble-ready is handled.
+    related_harness.set_can_connect(container, False)
+    related_harness.charm.on["community"].pebble_ready.emit(container)
+    related_harness.framework.commit()
+    app_data = related_harness.get_relation_data(metrics_id, "overleaf-k8s")
+    assert "overleaf-web" in {job["job_name"] for job in json.loads(app_data["scrape_jobs"])}
+
+    # The quota is read in a later dispatch, about something else.
+    related_harness.set_can_connect(container, True)
+    redis_id = related_harness.model.get_relation("redis").id
+    related_harness.update_relation_data(redis_id, "redis-k8s/0", {"nonce": "1"})
+    related_harness.framework.commit()
+
+    app_data = related_harness.get_relation_data(metrics_id, "overleaf-k8s")
+    jobs = {job["job_name"] for job in json.loads(app_data["scrape_jobs"])}
+    assert {"overleaf-web-0", "overleaf-web-1", "overleaf-web_api-1"} <= jobs
+    assert "overleaf-web" not in jobs
+    plan = related_harness.get_container_pebble_plan("community")
+    assert {"web-0", "web-1", "web_api-0", "web_api-1"} <= set(plan.services)
+
+
+def test_compile_role(harness: ops.testing.Harness[OverleafK8sCharm]):
+    harness.set_leader(True)
+    harness.update_config({"role": "compile"})
+    clsi_id = harness.add_relation("clsi", "overleaf-web")
+    harness.container_pebble_ready("community")
+    harness.framework.commit()
+
     assert harness.model.unit.status == ops.ActiveStatus()
+    # Each compile unit gives its own address.
+    assert harness.get_relation_data(clsi_id, "overleaf-k8s/0") == {
+        "host": "overleaf-k8s-0.overleaf-k8s-endpoints.overleaf.svc.cluster.local"
+    }
+    assert harness.get_relation_data(clsi_id, "overleaf-k8s") == {}
+    assert harness.model.unit.opened_ports() == {ops.Port("tcp", 3013)}
+    plan = harness.get_container_pebble_plan("community")
+    enabled = {name for name, service in plan.services.items() if service.startup == "enabled"}
+    assert enabled == {"clsi", services.COMPILE_CACHE, services.METRICS}
+    assert plan.services["clsi"].environment["LISTEN_ADDRESS"] == "0.0.0.0"
+    assert "FILESTORE_DOMAIN_OVERRIDE" not in plan.services["clsi"].environment
+
+    filestore = "http://overleaf-web-0.overleaf-web-endpoints.overleaf.svc.cluster.local:3009"
+    harness.update_relation_data(clsi_id, "overleaf-web", {"filestore": filestore})
+    harness.framework.commit()
+    plan = harness.get_container_pebble_plan("community")
+    assert plan.services["clsi"].environment["FILESTORE_DOMAIN_OVERRIDE"] == filestore
+
+
+def test_web_role_sends_compiles_to_the_workers(
+    related_harness: ops.testing.Harness[OverleafK8sCharm],
+):
+    related_harness.update_config({"role": "web"})
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    assert related_harness.get_container_pebble_plan("community").services == {}
+
+    workers_id = related_harness.add_relation("compile-workers", "overleaf-compile")
+    compile_units = []
+    for i in range(2):
+        unit = f"overleaf-compile/{i}"
+        host = f"overleaf-compile-{i}.overleaf-compile-endpoints.overleaf.svc.cluster.local"
+        related_harness.add_relation_unit(workers_id, unit)
+        related_harness.update_relation_data(workers_id, unit, {"host": host})
+        compile_units.append(host)
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.services["clsi"].startup == "disabled"
+    # web sends its compiles to the router, which sends each project to one unit.
+    assert plan.services["web"].environment["CLSI_HOST"] == "127.0.0.1"
+    assert plan.services[services.CLSI_ROUTER].startup == "enabled"
+    container = related_harness.model.unit.get_container("community")
+    config = container.pull(services.CLSI_ROUTER_CONFIG).read()
+    assert "hash $clsi_project consistent;" in config
+    for host in compile_units:
+        assert f"server {host}:3013;" in config
+    # The compile units fetch the project files from this unit's filestore.
+    assert related_harness.get_relation_data(workers_id, "overleaf-k8s") == {
+        "filestore": "http://overleaf-k8s-0.overleaf-k8s-endpoints.overleaf.svc.cluster.local:3009"
+    }
+    assert plan.services["filestore"].environment["LISTEN_ADDRESS"] == "0.0.0.0"
+
+    # When a compile unit leaves, the router stops sending compiles to it.
+    related_harness.remove_relation_unit(workers_id, "overleaf-compile/1")
+    related_harness.framework.commit()
+    config = container.pull(services.CLSI_ROUTER_CONFIG).read()
+    assert compile_units[0] in config
+    assert compile_units[1] not in config
+
+    related_harness.update_config({"role": "everything"})
+    related_harness.framework.commit()
+    assert related_harness.model.unit.status == ops.BlockedStatus(
+        "invalid config: role must be one of full, web, compile, not 'everything'"
+    )
+
+
+def test_node_heaps_share_the_memory_limit(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    container = related_harness.model.unit.get_container("community")
+    related_harness.set_can_connect(container, True)
+    container.push("/sys/fs/cgroup/memory.max", f"{4 << 30}\n", make_dirs=True)
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    # web has 4 of the 20 heap weights in 3 GiB.
+    web = plan.services["web"]
+    assert web.command == "/usr/bin/node --max-old-space-size=614 /overleaf/services/web/app.js"
+    assert "UV_THREADPOOL_SIZE" not in web.environment
+    assert plan.services["filestore"].environment["UV_THREADPOOL_SIZE"] == "16"
+
+    related_harness.update_config(
+        {
+            "node-options": "web:--max-old-space-size=2048 --expose-gc; chat:--expose-gc",
+            "uv-threadpool-size": "filestore:32",
+        }
+    )
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.services["web"].command == (
+        "/usr/bin/node --max-old-space-size=2048 --expose-gc /overleaf/services/web/app.js"
+    )
+    assert plan.services["chat"].command == (
+        "/usr/bin/node --max-old-space-size=153 --expose-gc /overleaf/services/chat/app.js"
+    )
+    assert plan.services["filestore"].environment["UV_THREADPOOL_SIZE"] == "32"
+
+    related_harness.update_config({"node-options": "web:-e 'process.exit()'"})
+    related_harness.framework.commit()
+    assert isinstance(related_harness.model.unit.status, ops.BlockedStatus)
+
+
+def test_workers_default_to_the_cpu_quota(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    container = related_harness.model.unit.get_container("community")
+    related_harness.set_can_connect(container, True)
+    container.push("/sys/fs/cgroup/cpu.max", "200000 100000\n", make_dirs=True)
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    enabled = {name for name, service in plan.services.items() if service.startup == "enabled"}
+    assert {"web-0", "web-1", "web_api-0", "web_api-1", "front"} <= enabled
+    assert not {"web", "web_api"} & enabled
+    assert plan.services["web-1"].environment["WEB_PORT"] == "4101"
+    assert plan.services["web-1"].environment["LISTEN_ADDRESS"] == "127.0.0.1"
+    front = container.pull("/etc/overleaf/charm-front.conf").read()
+    assert "listen 0.0.0.0:4000;" in front
+    assert "server 127.0.0.1:4101;" in front
+    assert "listen 127.0.0.1:3000;" in front
+    assert "server 127.0.0.1:4201;" in front
+
+    related_harness.update_config({"workers": "web:3; web_api:1"})
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    enabled = {name for name, service in plan.services.items() if service.startup == "enabled"}
+    assert {"web-0", "web-1", "web-2", "web_api", "front"} <= enabled
+    assert not {"web", "web_api-0", "web_api-1"} & enabled
+    assert not container.get_service("web_api-1").is_running()
+    front = container.pull("/etc/overleaf/charm-front.conf").read()
+    assert "server 127.0.0.1:4102;" in front
+    assert "3000" not in front
+
+    related_harness.update_config({"workers": "real_time:2"})
+    related_harness.framework.commit()
+    assert related_harness.model.unit.status == ops.BlockedStatus(
+        "invalid config: real_time can only run as one process"
+    )
+
+
+def test_pod_limits_are_read_before_the_relations(
+    harness: ops.testing.Harness[OverleafK8sCharm], request: pytest.FixtureRequest
+):
+    container = harness.model.unit.get_container("community")
+    harness.set_can_connect(container, True)
+    container.push("/sys/fs/cgroup/memory.max", f"{4 << 30}\n", make_dirs=True)
+    container.push("/sys/fs/cgroup/cpu.max", "200000 100000\n", make_dirs=True)
+    harness.container_pebble_ready("community")
+    harness.framework.commit()
+    assert harness.get_container_pebble_plan("community").services == {}
+
+    # The relations only arrive in later dispatches.
+    request.getfixturevalue("related_harness")
+    harness.framework.commit()
+
+    assert harness.charm._stored.memory_limit == 4 << 30
+    assert harness.charm._stored.cpu_quota == 2.0
+    plan = harness.get_container_pebble_plan("community")
+    assert {"web-0", "web-1", "front"} <= set(plan.services)
+    # Without the limit, the heaps would be left to Node's defaults.
+    assert "--max-old-space-size=" in plan.services["web-0"].command
+
+
+def test_ingress_waits_for_web(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    related_harness.add_network("10.1.2.3")
+    ingress_id = related_harness.add_relation("ingress", "traefik-k8s")
+    related_harness.add_relation_unit(ingress_id, "traefik-k8s/0")
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.services["docstore"].on_check_failure == {"docstore": "restart"}
+    assert plan.checks["docstore"].http == {"url": "http://127.0.0.1:3016/status"}
+    assert plan.checks["docstore"].threshold == 3
+    # A slow cold start of web isn't cut short by restarts.
+    assert plan.checks["web"].threshold == plan.checks["web_api"].threshold == 30
+    assert plan.checks["web-ready"].level == ops.pebble.CheckLevel.READY
+    assert plan.checks["web-ready"].threshold == 1
+    assert related_harness.model.unit.opened_ports() == {ops.Port("tcp", 4000)}
+    assert related_harness.get_relation_data(ingress_id, "overleaf-k8s/0")["ip"] == '"10.1.2.3"'
+
+    container = related_harness.model.unit.get_container("community")
+    check = related_harness._backend._pebble_clients["community"]._check_infos["web-ready"]
+    check.status = ops.pebble.CheckStatus.DOWN
+    related_harness.charm.on["community"].pebble_check_failed.emit(container, "web-ready")
+    related_harness.framework.commit()
+
+    assert related_harness.model.unit.opened_ports() == set()
+    assert related_harness.get_relation_data(ingress_id, "overleaf-k8s/0") == {}
+
+    check.status = ops.pebble.CheckStatus.UP
+    related_harness.charm.on["community"].pebble_check_recovered.emit(container, "web-ready")
+    related_harness.framework.commit()
+
+    assert related_harness.model.unit.opened_ports() == {ops.Port("tcp", 4000)}
+    assert related_harness.get_relation_data(ingress_id, "overleaf-k8s/0")
+
+
+def test_services_start_after_their_dependencies(
+    related_harness: ops.testing.Harness[OverleafK8sCharm],
+):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.services["docstore"].after == []
+    assert plan.services["project_history"].after == ["history_v1"]
+    assert {"docstore", "document_updater", "clsi"} <= set(plan.services["web"].after)
+    assert plan.services["real_time"].after == ["document_updater", "web_api"]
+
+    checks = related_harness._backend._pebble_clients["community"]._check_infos
+    checks["docstore"].successes = 3
+    checks["spelling"].successes = 0
+    starting = related_harness.charm._stored.starting
+    assert set(starting) == set(plan.services)
+    starting["docstore"] -= 60
+    related_harness.charm.on.update_status.emit()
+    related_harness.framework.commit()
+
+    # Two periods of successes before the charm looked.
+    assert 39 <= related_harness.charm._stored.time_to_listen["docstore"] <= 41
+    assert "docstore" not in starting
+    assert "spelling" in starting
+    output = related_harness.run_action("hook-stats")
+    assert "docstore" in output.results["time-to-listen"]
+
+
+def test_reconcile_hook_tool_ceiling(
+    related_harness: ops.testing.Harness[OverleafK8sCharm], monkeypatch: pytest.MonkeyPatch
+):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    backend = related_harness._backend
+    calls = []
+    for name in dir(backend):
+        method = getattr(backend, name)
+        if name.startswith("_") or not callable(method):
+            continue
+
+        def counted(*args, _name=name, _method=method, **kwargs):
+            calls.append(_name)
+            return _method(*args, **kwargs)
+
+        monkeypatch.setattr(backend, name, counted)
+    # Start from a cold model cache, as a fresh dispatch would.
+    relation_names = [
+        "database",
+        "redis",
+        "ingress",
+        "s3",
+        "logging",
+        "metrics-endpoint",
+        PEER_RELATION,
+        *services.REDIS_ROLES,
+    ]
+    for relation_name in relation_names:
+        related_harness.model.relations._invalidate(relation_name)
+    for requirer in (related_harness.charm.redis, *related_harness.charm.redis_roles.values()):
+        requirer._resolved = False
+
+    related_harness.charm.on["community"].pebble_ready.emit(
+        related_harness.model.unit.get_container("community")
+    )
+    related_harness.framework.commit()
+
+    assert calls.count("relation_ids") <= len(relation_names)
+    assert calls.count("relation_get") <= 3
+    # The real backend caches leadership, so is-leader is not a round trip.
+    calls = [call for call in calls if call != "is_leader"]
+    assert len(calls) <= 7 + len(relation_names), calls
+
+
+def test_hook_stats_action(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    output = related_harness.run_action("hook-stats", {"handler": "_reconcile"})
+
+    stats = output.results["handlers"]["overleafk8scharm-reconcile"]
+    assert int(stats["count"]) >= 2
+    assert float(stats["mean-pebble"]) > 0
+    assert output.results["layers-applied"] == 1
+    assert output.results["layers-skipped"] == 1
+    # The charm libraries' handlers are timed too.
+    assert (
+        "DatabaseRequires._on_relation_changed_event" in related_harness.charm.hook_stats.summary()
+    )
+
+
+def test_events_coalesce_into_one_reconcile(
+    related_harness: ops.testing.Harness[OverleafK8sCharm], monkeypatch: pytest.MonkeyPatch
+):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    charm = related_harness.charm
+    generation = charm._stored.generation
+    snapshots = []
+    read_snapshot = charm._read_snapshot
+    monkeypatch.setattr(charm, "_read_snapshot", lambda: snapshots.append(1) or read_snapshot())
+
+    # Several events in the same dispatch, only one of which changes anything.
+    redis_id = related_harness.model.get_relation("redis").id
+    related_harness.update_relation_data(redis_id, "redis-k8s/0", {"hostname": "redis-k8s-1"})
+    related_harness.update_relation_data(redis_id, "redis-k8s/0", {"nonce": "1"})
+    database_id = related_harness.model.get_relation("database").id
+    related_harness.update_relation_data(database_id, "mongodb-k8s", {"password": "rotated"})
+    assert snapshots == []
+    related_harness.framework.commit()
+
+    assert snapshots == [1]
+    assert charm._stored.generation == generation + 1
+    plan = related_harness.get_container_pebble_plan("community")
+    assert ":rotated@" in plan.services["web"].environment["OVERLEAF_MONGO_URL"]
+
+    # A later dispatch with the same inputs doesn't go near Pebble.
+    related_harness.update_relation_data(redis_id, "redis-k8s/0", {"nonce": "2"})
+    related_harness.framework.commit()
+    assert charm._stored.generation == generation + 1
+
+
+def test_migrations_run_once_on_the_leader(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    peers_id = related_harness.add_relation(PEER_RELATION, "overleaf-k8s")
+    related_harness.add_relation_unit(peers_id, "overleaf-k8s/1")
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    container = related_harness.model.unit.get_container("community")
+    container.push(f"{services.MIGRATIONS_DIR}/20240101_init.mjs", "", make_dirs=True)
+    runs = []
+
+    def handler(args: ops.testing.ExecArgs):
+        runs.append(args)
+        return ops.testing.ExecResult(stdout="Migrations done\n")
+
+    related_harness.handle_exec("community", ["npm"], handler=handler)
+
+    related_harness.charm.on.upgrade_charm.emit()
+    related_harness.framework.commit()
+    related_harness.charm.on.upgrade_charm.emit()
+    related_harness.framework.commit()
+
+    assert len(runs) == 1
+    assert runs[0].command == list(services.MIGRATIONS_COMMAND)
+    assert runs[0].environment["OVERLEAF_MONGO_URL"].startswith("mongodb://")
+    assert related_harness.get_relation_data(peers_id, "overleaf-k8s")[MIGRATED_KEY]
+
+    # A new image brings a new migration, but only the leader runs it.
+    container.push(f"{services.MIGRATIONS_DIR}/20240601_more.mjs", "")
+    related_harness.set_leader(False)
+    related_harness.charm.on.upgrade_charm.emit()
+    related_harness.framework.commit()
+    assert len(runs) == 1
+    assert related_harness.model.unit.status == ops.ActiveStatus()
+
+    # The leader of the time ran it; this unit doesn't again when it takes over.
+    related_harness.update_relation_data(
+        peers_id, "overleaf-k8s", {MIGRATED_KEY: _migrations_marker(container) or ""}
+    )
+    related_harness.set_leader(True)
+    related_harness.charm.on.upgrade_charm.emit()
+    related_harness.framework.commit()
+    assert len(runs) == 1
+
+    output = related_harness.run_action("run-migrations")
+    assert len(runs) == 2
+    assert output.results["output"] == "Migrations done\n"
+
+
+def test_compile_scratch_storage(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    container = related_harness.model.unit.get_container("community")
+
+    assert container.isdir(f"{services.DATA_PATH}/user_files")
+    assert container.isdir(f"{services.TMP_PATH}/uploads")
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.services["web"].environment["OVERLEAF_DATA_PATH"] == services.DATA_PATH
+    assert "OVERLEAF_CONFIG" not in plan.services["clsi"].environment
+
+    related_harness.add_storage("compile-scratch", attach=True)
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    assert container.isdir(f"{services.SCRATCH_PATH}/compiles")
+    settings = container.pull(services.SCRATCH_SETTINGS).read()
+    assert f"compilesDir: '{services.SCRATCH_PATH}/compiles'" in settings
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.services["clsi"].environment["OVERLEAF_CONFIG"] == services.SCRATCH_SETTINGS
+    assert "OVERLEAF_CONFIG" not in plan.services["web"].environment
+
+    # The janitor's script is in place whenever the janitor is started.
+    container.remove_path(services.COMPILE_CACHE_SCRIPT)
+    related_harness.update_config({"compile-cache-size": "10G"})
+    related_harness.framework.commit()
+    assert container.exists(services.COMPILE_CACHE_SCRIPT)
+
+    # The storage can be emptied without the pod being replaced.
+    container.remove_path(f"{services.DATA_PATH}/user_files")
+    related_harness.update_config({"workers": "web:2"})
+    related_harness.framework.commit()
+    assert container.isdir(f"{services.DATA_PATH}/user_files")
@@ -0,0 +1,69 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+import os
+import pathlib
+
+import pytest
+
+import compile_cache
+
+
+def _compile(root: pathlib.Path, key: str, size: int, when: float):
+    """Leave a project's compile and output directories as clsi would."""
+    for subdir in compile_cache.SUBDIRS:
+        path = root / subdir / key
+        path.mkdir(parents=True, exist_ok=True)
+        (path / "output.log").write_bytes(b"x" * size)
+        os.utime(path / "output.log", (when, when))
+        os.utime(path, (when, when))
+
+
+@pytest.fixture
+def root(tmp_path: pathlib.Path) -> pathlib.Path:
+    for subdir in compile_cache.SUBDIRS:
+        (tmp_path / subdir).mkdir()
+    return tmp_path
+
+
+def test_evicts_least_recently_compiled(root: pathlib.Path):
+    now = 100_000.0
+    for i, key in enumerate(["old", "older", "recent"]):
+        _compile(root, key, 64 * 1024, now - [5000, 9000, 1000][i])
+    sizes = compile_cache.scan([str(root / subdir) for subdir in compile_cache.SUBDIRS], {})
+    janitor = compile_cache.Janitor(str(root), budget=sizes["old"].size * 5 // 2)
+
+    janitor.run_once(now)
+
+    assert set(janitor.entries) == {"old", "recent"}
+    assert not (root / "compiles" / "older").exists()
+    assert not (root / "output" / "older").exists()
+    assert janitor.counters["evictions"] == 1
+    assert janitor.counters["evicted_bytes"] == sizes["older"].size
+
+
+def test_spares_compiles_in_progress():
+    entries = {
+        "busy": compile_cache.Entry(last_used=990, size=100),
+        "idle": compile_cache.Entry(last_used=0, size=100),
+    }
+
+    assert compile_cache.select_evictions(entries, budget=50, now=1000) == ["idle"]
+
+
+def test_counts_hits_across_restarts(root: pathlib.Path):
+    now = 100_000.0
+    _compile(root, "project", 1024, now - 2000)
+    compile_cache.Janitor(str(root), budget=1 << 30).run_once(now)
+
+    # A restarted janitor finds the project compiled again, in its old directory.
+    janitor = compile_cache.Janitor(str(root), budget=1 << 30)
+    _compile(root, "project", 1024, now - 1000)
+    _compile(root, "new", 1024, now - 1000)
+    janitor.run_once(now)
+
+    assert janitor.counters["hits"] == 1
+    assert janitor.counters["misses"] == 2
+    metrics = janitor.metrics()
+    assert "overleaf_compile_cache_hits_total 1" in metrics
+    assert "overleaf_compile_cache_evicted_bytes_total 0" in metrics
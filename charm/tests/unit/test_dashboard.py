@@ -0,0 +1,24 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+import dashboard
+import services
+
+
+def test_dashboard_file_is_up_to_date():
+    # Run src/dashboard.py to build it again.
+    assert dashboard.DASHBOARD_FILE.read_text() == dashboard.render()
+
+
+def test_every_service_has_a_row():
+    rows = {panel["title"] for panel in dashboard.build()["panels"] if panel["type"] == "row"}
+    assert set(services.SERVICE_NAMES) <= rows
+
+
+def test_event_loop_lag_is_in_seconds():
+    panels = {panel["title"]: panel for panel in dashboard.build()["panels"]}
+    lag = panels["web event loop lag"]
+    assert lag["fieldConfig"]["defaults"]["unit"] == "s"
+    assert "nodejs_eventloop_lag_p99_seconds" in lag["targets"][0]["expr"]
+    cpu = panels["web CPU"]
+    assert all("eventloop" not in target["expr"] for target in cpu["targets"])
@@ -0,0 +1,121 @@
+# Copyright 2024 Ubuntu
+# See LICENSE file for licensing details.
+
+import ops
+import ops.testing
+import pytest
+
+import mongo
+from charm import OverleafK8sCharm
+
+
+@pytest.mark.parametrize("members", [1, 3, 7])
+def test_uri_seeds_every_member(
+    related_harness: ops.testing.Harness[OverleafK8sCharm], members: int
+):
+    endpoints = ",".join(f"mongodb-k8s-{i}.mongodb-k8s-endpoints:27017" for i in range(members))
+    database_id = related_harness.model.get_relation("database").id
+    related_harness.update_relation_data(
+        database_id, "mongodb-k8s", {"endpoints": endpoints, "replset": "overleaf-rs"}
+    )
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    uri = plan.services["web"].environment["OVERLEAF_MONGO_URL"]
+    mongo.validate_uri(uri)
+    assert uri.startswith(
+        f"mongodb://overleaf:secret@{endpoints}/overleaf?replicaSet=overleaf-rs&authSource=admin&"
+    )
+
+
+def test_per_service_connection_options(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    related_harness.update_config(
+        {"mongo-options": "docstore:readPreference=secondaryPreferred&maxPoolSize=20"}
+    )
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+
+    plan = related_harness.get_container_pebble_plan("community")
+    docstore = plan.services["docstore"].environment["OVERLEAF_MONGO_URL"]
+    assert docstore.endswith(
+        "maxPoolSize=20&minPoolSize=2&maxIdleTimeMS=300000&readPreference=secondaryPreferred"
+    )
+    web = plan.services["web"].environment["OVERLEAF_MONGO_URL"]
+    assert web.endswith(
+        "maxPoolSize=100&minPoolSize=5&maxIdleTimeMS=300000&readPreference=primary"
+    )
+    # Web's client options override the pool size in the URI.
+    assert plan.services["web"].environment["MONGO_POOL_SIZE"] == "100"
+    assert "MONGO_POOL_SIZE" not in plan.services["docstore"].environment
+    contacts = plan.services["contacts"].environment["OVERLEAF_MONGO_URL"]
+    assert contacts.endswith("readPreference=secondaryPreferred")
+
+    related_harness.update_config({"mongo-options": "web_api:maxPoolSize=40"})
+    related_harness.framework.commit()
+    plan = related_harness.get_container_pebble_plan("community")
+    assert plan.services["web_api"].environment["MONGO_POOL_SIZE"] == "40"
+    assert "OVERLEAF_MONGO_URL" not in plan.services["clsi"].environment
+
+    related_harness.update_config({"mongo-options": "docstore:readPreference=fastest"})
+    related_harness.framework.commit()
+    assert isinstance(related_harness.model.unit.status, ops.BlockedStatus)
+
+
+def test_replica_set_from_uris():
+    data = {"uris": "mongodb://u:p@a:27017,b:27017/overleaf?replicaSet=from-uris&authSource=admin"}
+    assert mongo.replica_set(data) == "from-uris"
+    assert mongo.replica_set({"replset": "from-replset", **data}) == "from-replset"
+    assert mongo.replica_set({}) is None
+
+
+def test_build_uri_quotes_credentials_and_defaults_port():
+    hosts = mongo.parse_endpoints("a,b:27018")
+    assert hosts == [("a", 27017), ("b", 27018)]
+    uri = mongo.build_uri("user", "p@ss/word:", hosts, "overleaf")
+    assert uri == "mongodb://user:p%40ss%2Fword%3A@a:27017,b:27018/overleaf?authSource=admin"
+    assert mongo.redact(uri) == "mongodb://user:***@a:27017,b:27018/overleaf?authSource=admin"
+
+
+def test_ipv6_endpoints():
+    hosts = mongo.parse_endpoints("[fd00::1]:27018,[fd00::2],fd00::3")
+    assert hosts == [("fd00::1", 27018), ("fd00::2", 27017), ("fd00::3", 27017)]
+    uri = mongo.build_uri("user", "pass", hosts, "overleaf")
+    assert uri.startswith("mongodb://user:pass@[fd00::1]:27018,[fd00::2]:27017,[fd00::3]:27017/")
+    mongo.validate_uri(uri)
+
+
+@pytest.mark.parametrize("endpoints", ["host:abc", "host:99999", "[fd00::1:27017", "[fd00::1]x"])
+def test_parse_endpoints_rejects(endpoints: str):
+    with pytest.raises(mongo.InvalidMongoURIError):
+        mongo.parse_endpoints(endpoints)
+
+
+def test_invalid_endpoints_block_the_unit(related_harness: ops.testing.Harness[OverleafK8sCharm]):
+    database_id = related_harness.model.get_relation("database").id
+    related_harness.update_relation_data(database_id, "mongodb-k8s", {"endpoints": "host:abc"})
+    related_harness.container_pebble_ready("community")
+    related_harness.framework.commit()
+    assert related_harness.model.unit.status == ops.BlockedStatus("invalid MongoDB relation data")
+
+    related_harness.update_relation_data(
+        database_id, "mongodb-k8s", {"endpoints": "[fd00::1]:27017"}
+    )
+    related_harness.framework.commit()
+    assert related_harness.model.unit.status == ops.ActiveStatus()
+    plan = related_harness.get_container_pebble_plan("community")
+    assert "@[fd00::1]:27017/" in plan.services["web"].environment["OVERLEAF_MONGO_URL"]
+
+
+@pytest.mark.parametrize(
+    "uri",
+    [
+        "postgres://u:p@a:27017/db",
+        "mongodb://u:p@/db",
+        "mongodb://u:p@a:99999/db",
+        "mongodb://u:p@a:27017/bad.name",
+    ],
+)
+def test_validate_uri_rejects(uri: str):
+    with pytest.raises(mongo.InvalidMongoURIError):
+        mongo.validate_uri(uri)